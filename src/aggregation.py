@@ -1,12 +1,22 @@
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import shapely
+import scipy.sparse as sparse
 import os
+import multiprocessing as mp
+from tqdm import tqdm
 from src.s2_grid import split_polygon
+from src.utils import S2GridParams, load_params
+from src.picture_store import has_picture, remove_partial_writes, write_picture
+from src.preprocessing import clip_to, read_boundary
+from src.layers import layer_path, read_layer
+from src.partition import UNCLIPPED_LAYERS, LayerPartition, load_partitions
 
 
 
-def create_pixels_gdf(picture):
-    pixels = split_polygon(picture, number_of_pixels_on_side = 25, thresh = 0.99)
+def create_pixels_gdf(picture, params: S2GridParams = None):
+    pixels = split_polygon(picture, number_of_pixels_on_side = 25, thresh = 0.99, params = params)
     pixels = gpd.GeoDataFrame(pixels).rename(columns={0: "geometry"})
     pixels.set_geometry('geometry', inplace=True)
     pixels.set_crs('EPSG:5514', inplace=True)
@@ -14,161 +24,281 @@ def create_pixels_gdf(picture):
 
 
 
-def calculate_weighted_db(pixel, noise_gdf):
-    total_area = pixel.area  # Total area of the square
-    weighted_sum = 0  # Weighted sum of DB_HI
-    total_weight = 0  # Total weight (should sum to 1 if fully covered)
+def intersecting_pairs(pixels: gpd.GeoDataFrame, layer: gpd.GeoDataFrame) -> tuple[np.ndarray, np.ndarray]:
+    # All (pixel, feature) index pairs whose geometries intersect, ordered by pixel and then
+    # by feature so that per-pixel reductions always accumulate in the layer's order
+    tree = shapely.STRtree(np.asarray(layer.geometry))
+    pixel_idx, feature_idx = tree.query(np.asarray(pixels.geometry), predicate = 'intersects')
+    order = np.lexsort((feature_idx, pixel_idx))
+    return pixel_idx[order], feature_idx[order]
 
-    for _, noise in noise_gdf.iterrows():
-        # Calculate intersection geometry between pixel and noise polygon
-        intersection = pixel.intersection(noise.geometry)
 
-        # If there's an intersection, calculate the weight and add to the weighted sum
-        if intersection.is_valid and not intersection.is_empty:
-            intersection_area = intersection.area
-            weight = intersection_area / total_area  # Weight based on area covered
-            weighted_sum += weight * noise["DB_HI"]
-            total_weight += weight
 
-    # Return the weighted average, default to 0 if there's no coverage
-    return round(weighted_sum / 5) * 5 if total_weight > 0 else 0
+def calculate_weighted_db_bulk(pixels: gpd.GeoDataFrame, noise_gdf: gpd.GeoDataFrame) -> np.ndarray:
+    pixel_geoms = np.asarray(pixels.geometry)
+    pixel_idx, noise_idx = intersecting_pairs(pixels, noise_gdf)
 
+    # Intersect every pixel-noise pair in one call, keep the valid non-empty intersections
+    intersections = shapely.intersection(pixel_geoms[pixel_idx], np.asarray(noise_gdf.geometry)[noise_idx])
+    keep = shapely.is_valid(intersections) & ~shapely.is_empty(intersections)
+    pixel_idx = pixel_idx[keep]
+    weights = shapely.area(intersections[keep]) / shapely.area(pixel_geoms[pixel_idx])
+    db_hi = noise_gdf["DB_HI"].to_numpy(dtype = float)[noise_idx[keep]]
 
+    weighted_sum = np.bincount(pixel_idx, weights = weights * db_hi, minlength = len(pixel_geoms))
+    total_weight = np.bincount(pixel_idx, weights = weights, minlength = len(pixel_geoms))
 
-def get_max_speed(pixel, roads_for_picture):
-    intersecting_roads = roads_for_picture[roads_for_picture.geometry.intersects(pixel)]
-    
-    if not intersecting_roads.empty:
-        # Convert 'maxspeed' column to numeric, handle missing values, and find the max
-        return pd.to_numeric(intersecting_roads["maxspeed"], errors = "coerce").max(skipna = True)
+    # Sum of DB_HI weighted by the covered share of the pixel, rounded to 5 dB, 0 for pixels without coverage
+    return np.where(total_weight > 0, np.round(weighted_sum / 5) * 5, 0).astype(int)
+
+
+
+def get_max_speed_bulk(pixels: gpd.GeoDataFrame, roads_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    pixel_idx, road_idx = intersecting_pairs(pixels, roads_for_picture)
+    speeds = pd.to_numeric(roads_for_picture["maxspeed"], errors = "coerce").to_numpy(dtype = float)
     
-    return 0  # If no road is found in the square
+    # Max over intersecting roads (NaN if none of them has a numeric speed), 0 if no road is found
+    max_speed = pd.Series(speeds[road_idx]).groupby(pixel_idx).max()
+    result = np.zeros(len(pixels))
+    result[max_speed.index.to_numpy()] = max_speed.to_numpy()
+    return result
 
 
 
-def get_barrier(pixel, bariers_for_pixel):
-    if bariers_for_pixel.geometry.intersects(pixel).any():
-        return 1
-    else:
-        return 0
+def get_barrier_bulk(pixels: gpd.GeoDataFrame, bariers_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    pixel_idx, _ = intersecting_pairs(pixels, bariers_for_picture)
+    return (np.bincount(pixel_idx, minlength = len(pixels)) > 0).astype(int)
+
+
+
+def has_transport_line_bulk(pixels: gpd.GeoDataFrame, transport_lines_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    pixel_idx, _ = intersecting_pairs(pixels, transport_lines_for_picture)
+    return np.bincount(pixel_idx, minlength = len(pixels)) > 0
+
+
+
+def get_buildings_levels_bulk(pixels: gpd.GeoDataFrame, buildings_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    pixel_geoms = np.asarray(pixels.geometry)
+    pixel_idx, building_idx = intersecting_pairs(pixels, buildings_for_picture)
+    pairs = pd.DataFrame({
+        'pixel': pixel_idx,
+        'buildings_levels': buildings_for_picture['buildings_levels'].to_numpy()[building_idx],
+        'intersected_area': shapely.area(shapely.intersection(pixel_geoms[pixel_idx], 
+                                                              np.asarray(buildings_for_picture.geometry)[building_idx])),
+    })
+
+    # Levels covering the largest area of each pixel, ties resolved by the lowest levels
+    area_by_levels = pairs.groupby(['pixel', 'buildings_levels'])['intersected_area'].sum()
+    max_levels = area_by_levels.groupby(level = 'pixel').idxmax()
+    result = np.zeros(len(pixels))
+    result[max_levels.index.to_numpy()] = [levels for _, levels in max_levels]
+    return result
+
 
 
+def get_parks_area_bulk(pixels: gpd.GeoDataFrame, parks_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    # Covered share of every pixel from one bulk intersection, overlapping parks count twice
+    pixel_geoms = np.asarray(pixels.geometry)
+    pixel_idx, park_idx = intersecting_pairs(pixels, parks_for_picture)
+    intersections = shapely.intersection(pixel_geoms[pixel_idx], np.asarray(parks_for_picture.geometry)[park_idx])
+    keep = ~shapely.is_empty(intersections)
+    parks_area = np.bincount(pixel_idx[keep], weights = shapely.area(intersections[keep]), minlength = len(pixel_geoms))
+    return np.where(parks_area > 0, parks_area / shapely.area(pixel_geoms), 0)
 
-def get_buildings_levels(pixel, buildings_for_pixel):
-    intersecting_buildings = buildings_for_pixel[buildings_for_pixel.geometry.intersects(pixel)].copy()
+
+
+def overlap_matrix(pixels: gpd.GeoDataFrame, 
+                   zones: gpd.GeoDataFrame, 
+                   zone_area: np.ndarray = None) -> sparse.csr_matrix:
+    # (pixels, zones) matrix with the share of each zone's area that lies in each pixel. Multiplying it
+    # by any areal attribute of the zones spreads that attribute evenly over their area
+    zone_area = shapely.area(np.asarray(zones.geometry)) if zone_area is None else np.asarray(zone_area, dtype = float)
+    pixel_idx, zone_idx = intersecting_pairs(pixels, zones)
+    intersections = shapely.intersection(np.asarray(pixels.geometry)[pixel_idx], np.asarray(zones.geometry)[zone_idx])
+    keep = ~shapely.is_empty(intersections)
+    shares = shapely.area(intersections[keep]) / zone_area[zone_idx[keep]]
+    return sparse.csr_matrix((shares, (pixel_idx[keep], zone_idx[keep])), shape = (len(pixels), len(zones)))
+
+
+
+def interpolate_areal(pixels: gpd.GeoDataFrame, 
+                      zones: gpd.GeoDataFrame, 
+                      columns: list[str], 
+                      zone_area: np.ndarray = None) -> pd.DataFrame:
+    # Any number of attributes, e.g. every count in DEMOGRAPHY.geojson, from one overlap matrix
+    matrix = overlap_matrix(pixels, zones, zone_area)
+    values = zones[columns].apply(pd.to_numeric, errors = 'coerce').fillna(0).to_numpy(dtype = float)
+    return pd.DataFrame(matrix @ values, columns = columns, index = pixels.index)
+
+
+
+def get_population_bulk(pixels: gpd.GeoDataFrame, population_for_picture: gpd.GeoDataFrame) -> np.ndarray:
+    zone_area = population_for_picture['district_area'] if 'district_area' in population_for_picture else None
+    return interpolate_areal(pixels, population_for_picture, ['population'], zone_area)['population'].to_numpy()
+
+
+
+def load_layers() -> dict[str, gpd.GeoDataFrame]:
+    # Every layer comes from the shared catalogue, with only the columns the aggregation uses
+    noise = read_layer('noise', ['DB_HI'])
+    transport_lines = read_layer('transport_lines', [])
+    noise_barriers = pd.concat([read_layer('noise_barriers_1', []), read_layer('noise_barriers_2', [])]).reset_index(drop = True)
+    parks = read_layer('parks', [])
+    buildings = read_layer('buildings', ['buildings_levels'])
+    population = read_layer('population')
+    roads = read_layer('roads', ['maxspeed'])
     
-    if not intersecting_buildings.empty:
-        intersecting_buildings['intersected_area'] = intersecting_buildings.geometry.intersection(pixel).area
-        area_by_levels = intersecting_buildings.groupby('buildings_levels')['intersected_area'].sum()
-        max_levels = area_by_levels.idxmax()
-        return max_levels
+    if not isinstance(population, gpd.GeoDataFrame) or 'geometry' not in population.columns:
+        population = gpd.GeoDataFrame({'geometry': population})
+    # Computed once here instead of for every pixel the district overlaps
+    population['district_area'] = population.geometry.area
+
+    noise_bounds = read_boundary(layer_path('noise'))
+    transport_lines = clip_to(transport_lines, noise_bounds)
+    roads = clip_to(roads, noise_bounds)
+    noise_barriers = clip_to(noise_barriers, noise_bounds)
+
+    return {
+        'noise': noise,
+        'roads': roads,
+        'transport_lines': transport_lines,
+        'noise_barriers': noise_barriers,
+        'parks': parks,
+        'buildings': buildings,
+        'population': population,
+    }
+
+
+
+def aggregate_picture(picture, 
+                      layers: dict[str, gpd.GeoDataFrame], 
+                      params: S2GridParams = None,
+                      partitions: dict[str, LayerPartition] = None,
+                      picture_id: int = None) -> gpd.GeoDataFrame:
+    if partitions is not None:
+        # Each layer's features for the picture are looked up by id, see partition.LayerPartition
+        pixels = create_pixels_gdf(picture, params)
+        layers_for_picture = {name: partitions[name].subset(layer, picture_id, picture, clip = name not in UNCLIPPED_LAYERS)
+                              for name, layer in layers.items()}
+        return aggregate_pixels(pixels, layers_for_picture)
+
+    noise_for_picture = clip_to(layers['noise'], picture)
+    roads_for_picture = clip_to(layers['roads'], picture)
+    transport_lines_for_picture = clip_to(layers['transport_lines'], picture)
+    buildings_for_picture = clip_to(layers['buildings'], picture)
+    bariers_for_picture = clip_to(layers['noise_barriers'], picture)
+    parks_for_picture = clip_to(layers['parks'], picture)
     
-    else:
-        return 0
+    population = layers['population']
+    population_subgdf = gpd.GeoDataFrame({'geometry': [picture]}, crs = population.crs)
+    population_for_picture = gpd.sjoin(population, population_subgdf, how = 'inner', predicate = 'intersects')
+    population_for_picture = population_for_picture.drop(columns = 'index_right')
 
+    pixels = create_pixels_gdf(picture, params)
+    layers_for_picture = {
+        'noise': noise_for_picture,
+        'roads': roads_for_picture,
+        'transport_lines': transport_lines_for_picture,
+        'noise_barriers': bariers_for_picture,
+        'parks': parks_for_picture,
+        'buildings': buildings_for_picture,
+        'population': population_for_picture,
+    }
+    return aggregate_pixels(pixels, layers_for_picture)
 
 
-def get_parks_area(pixel, parks_for_pixel):
-    parks_area = 0
-    for _, park in parks_for_pixel.iterrows():
-        intersecting_park = pixel.intersection(park.geometry)
-        if intersecting_park:
-            parks_area += intersecting_park.area
 
-    return parks_area / pixel.area if parks_area > 0 else 0
+def layers_for_area(layers: dict[str, gpd.GeoDataFrame], area) -> dict[str, gpd.GeoDataFrame]:
+    # Features intersecting the area, picked with the spatial index and left unclipped. The pixel
+    # features only depend on the parts of the geometries inside each pixel, so clipping is not needed
+    return {name: layer.iloc[np.sort(layer.sindex.query(area, predicate = 'intersects'))] 
+            for name, layer in layers.items()}
 
 
 
-def get_population(pixel, population_for_pixel):
-    population = 0
-    for _, row in population_for_pixel.iterrows():
-        intersecting_district = pixel.intersection(row.geometry)
-        if intersecting_district:
-            population += intersecting_district.area / row.geometry.area * row.population
+def aggregate_pixels(pixels: gpd.GeoDataFrame, layers: dict[str, gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
+    #liczenie wzonego halasu dla kazdego piksela
+    pixels["weighted_db_hi"] = calculate_weighted_db_bulk(pixels, layers['noise'])
+    
+    #droga z max predkoscia na pixeulu
+    pixels["max_speed"] = get_max_speed_bulk(pixels, layers['roads'])
     
-    return population
+    #czy pixel posiada transport line
+    pixels['has_transport_line'] = has_transport_line_bulk(pixels, layers['transport_lines'])
+
+    #noise barriers
+    pixels['has_barrier'] = get_barrier_bulk(pixels, layers['noise_barriers'])
+
+    #parks
+    pixels['parks_area'] = get_parks_area_bulk(pixels, layers['parks'])
+
+    #buildings
+    pixels['buildings_levels'] = get_buildings_levels_bulk(pixels, layers['buildings'])
+
+    #population
+    pixels['population'] = get_population_bulk(pixels, layers['population'])
+
+    return pixels
+
+
+
+_worker_layers = None
+_worker_params = None
+_worker_partitions = None
+
+
+def _init_worker(layers: dict[str, gpd.GeoDataFrame], 
+                 params: S2GridParams, 
+                 partitions: dict[str, LayerPartition] = None) -> None:
+    # With the fork start method the layers are inherited from the parent without copying
+    global _worker_layers, _worker_params, _worker_partitions
+    _worker_layers = layers
+    _worker_params = params
+    _worker_partitions = partitions
+    return
+
+
+def _process_picture(task: tuple) -> int:
+    i, picture = task
+    pixels = aggregate_picture(picture, _worker_layers, _worker_params, _worker_partitions, i)
+    write_picture(pixels, i)
+    return i
+
+
+
+def aggregate_pictures(tasks: list[tuple], workers: int = 1, params: S2GridParams = None) -> None:
+    # Aggregates (picture_id, geometry) tasks of the S2 grid into the picture store
+    if not tasks:
+        return
+    layers = load_layers()
+    partitions = load_partitions(layers)
+    if workers == 1:
+        _init_worker(layers, params, partitions)
+        for task in tqdm(tasks, desc = "Aggregation"):
+            _process_picture(task)
+    else:
+        context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        with context.Pool(workers, initializer = _init_worker, initargs = (layers, params, partitions)) as pool:
+            # chunksize = 1 hands out pictures one by one, so dense pictures do not stall a worker's queue
+            for _ in tqdm(pool.imap_unordered(_process_picture, tasks, chunksize = 1), 
+                          total = len(tasks), desc = f"Aggregation ({workers} workers)"):
+                pass
+    return
 
 
 
 def main():
     print('DATA AGGREGATION STARTED')
     
+    params = load_params()
+    workers = params.aggregation_params.workers or os.cpu_count()
+
     pictures = gpd.read_file("data/S2_GRID.geojson")
-    noise = gpd.read_file("data/NOISE.geojson")
-    transport_lines = gpd.read_file("data/TRANSPORT_LINES.geojson")
-    noise_barriers_1 = gpd.read_file('data/NOISE_BARRIERS.geojson')
-    noise_barriers_2 = gpd.read_file('data/NOISE_BARRIERS_2.geojson')
-    noise_barriers_1.drop(columns = 'ID_CLONA', inplace = True)
-    noise_barriers_2.drop(columns = 'ID_VAL', inplace = True)
-    noise_barriers = pd.concat([noise_barriers_1, noise_barriers_2]).reset_index(drop = True)
-    parks = gpd.read_file('data/PARKS.geojson')
-    buildings = gpd.read_file('data/BUILDINGS.geojson')
-    population = gpd.read_file('data/DEMOGRAPHY.geojson')
-    roads = gpd.read_file('data/ROADS.geojson')
-    
-    if not isinstance(population, gpd.GeoDataFrame) or 'geometry' not in population.columns:
-        population = gpd.GeoDataFrame({'geometry': population})
+    remove_partial_writes()
+    tasks = [(i, picture) for i, picture in enumerate(pictures['geometry']) if not has_picture(i)]
+    print(f"{len(pictures) - len(tasks)} pictures already processed, {len(tasks)} left")
     
-    # # Validate and correct geometries
-    # noise.geometry = noise.geometry.buffer(0)
-    # transport_lines.geometry = transport_lines.geometry.buffer(0)
-    # # noise_barriers.geometry = noise_barriers.geometry.buffer(0)
-    # parks.geometry = parks.geometry.buffer(0)
-    # buildings.geometry = buildings.geometry.buffer(0)
-    # # population = population.buffer(0)
-    # roads.geometry = roads.geometry.buffer(0)
-
-    noise_bounds = noise.unary_union
-    transport_lines = gpd.clip(transport_lines, noise_bounds)
-    roads = gpd.clip(roads, noise_bounds)
-    noise_barriers = gpd.clip(noise_barriers, noise_bounds)
-
-    for i, picture in enumerate(pictures['geometry']):
-        if os.path.exists(f"data/pictures/picture_{i}.geojson"):
-            print(f"Picture {i} already processed")
-            continue
-        else:
-            noise_for_picture = gpd.clip(noise, picture)
-            roads_for_picture = gpd.clip(roads, picture)
-            transport_lines_for_picture = gpd.clip(transport_lines, picture)
-            buildings_for_picture = gpd.clip(buildings, picture)
-            bariers_for_picture = gpd.clip(noise_barriers, picture)
-            try:
-                parks_for_picture = gpd.clip(parks, picture)
-            except:
-                parks_copy = parks.copy()
-                parks_copy.geometry = parks_copy.geometry.buffer(0)
-                parks_for_picture = gpd.clip(parks_copy, picture)
-            
-            population_subgdf = gpd.GeoDataFrame({'geometry': [picture]}, crs = population.crs)
-            population_for_picture = gpd.sjoin(population, population_subgdf, how = 'inner', predicate = 'intersects')
-            population_for_picture = population_for_picture.drop(columns = 'index_right')
-
-            pixels = create_pixels_gdf(picture)
-
-            #liczenie wzonego halasu dla kazdego piksela
-            pixels["weighted_db_hi"] = pixels.geometry.apply(lambda pixel: calculate_weighted_db(pixel, noise_for_picture))
-            
-            #droga z max predkoscia na pixeulu
-            pixels["max_speed"] = pixels["geometry"].apply(lambda pixel: get_max_speed(pixel, roads_for_picture))
-            
-            #czy pixel posiada transport line
-            pixels['has_transport_line'] = pixels.geometry.apply(lambda pixel: transport_lines_for_picture.geometry.intersects(pixel).any())
-
-            #noise barriers
-            pixels['has_barrier'] = pixels.geometry.apply(lambda pixel: get_barrier(pixel, bariers_for_picture))
-
-            #parks
-            pixels['parks_area'] = pixels.geometry.apply(lambda pixel: get_parks_area(pixel, parks_for_picture))
-
-            #buildings
-            pixels['buildings_levels'] = pixels.geometry.apply(lambda pixel: get_buildings_levels(pixel, buildings_for_picture))
-
-            #population
-            pixels['population'] = pixels.geometry.apply(lambda pixel: get_population(pixel, population_for_picture))
-            
-            pixels.to_file(f"data/pictures/picture_{i}.geojson", driver = "GeoJSON")
-            print(f"Picture {i} processed")
+    aggregate_pictures(tasks, workers, params.s2_grid_params)
         
     print('DATA AGGREGATION FINISHED')
 
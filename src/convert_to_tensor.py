@@ -1,34 +1,124 @@
+import os
+import json
 import torch
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-import os
-import glob 
-import re 
+from src.picture_store import FEATURE_COLUMNS, STORE_PATH, part_path, picture_ids, read_pictures
+from src.utils import file_sha256
 
 
 
-def transform_to_tensor(filepath: str) -> torch.tensor:
-    gdf = gpd.read_file(filepath)
-    df = gdf.drop(columns=['geometry'])
-    df = df.apply(pd.to_numeric, errors='coerce').fillna(0).astype('float32')
-    tensor = torch.tensor(df.values.reshape(25, 25, 7))
-    tensor[0] = tensor[0].flip(dims=[0])
-    tensor = tensor.flip(dims=[0])
-    return tensor    
+def pictures_to_tensor(df: pd.DataFrame) -> torch.tensor:
+    # Rows are sorted by picture and row-major pixel position, as returned by read_pictures
+    df = df[FEATURE_COLUMNS].apply(pd.to_numeric, errors='coerce').fillna(0).astype('float32')
+    return torch.tensor(df.values.reshape(-1, 25, 25, len(FEATURE_COLUMNS)))
 
 
 
-def main() -> None:
-    geojson_files = glob.glob(os.path.join('data/pictures', '*.geojson'))
-    files_sorted = sorted(geojson_files, key=lambda x: int(re.search(r"(\d+)", x).group()))
+def _write_header(path: str, shape: tuple, ids: list[int], labels: list[float]) -> None:
+    header = {
+        'shape': list(shape),
+        'dtype': 'float32',
+        'channels': FEATURE_COLUMNS,
+        'picture_ids': ids,
+        # Mean noise of every picture, so the datasets never read the whole file to label it
+        'labels': labels,
+    }
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(header, f, indent = 4)
+    return
+
+
+
+def _grow_tensors(path: str, n_samples: int, chunk_size: int = 1024) -> np.ndarray:
+    # Copy the existing samples into a larger file chunk by chunk, then swap it in
+    old = np.load(path, mmap_mode = 'r') if os.path.exists(path) else np.empty((0, 25, 25, len(FEATURE_COLUMNS)), np.float32)
+    tmp_path = f"{path}.tmp"
+    new = np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = np.float32, shape = (n_samples, *old.shape[1:]))
+    for start in range(0, old.shape[0], chunk_size):
+        stop = min(start + chunk_size, old.shape[0])
+        new[start:stop] = old[start:stop]
+    new.flush()
+    del old, new
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode = 'r+')
+
+
 
-    tensors_list = []
-    for file in files_sorted:
-        tensor = transform_to_tensor(file)
-        tensors_list.append(tensor)
+def convert_incremental(path: str = 'data_to_train/tensors.npy', 
+                        store_path: str = STORE_PATH) -> dict[str, list[int]]:
+    # The manifest maps picture id -> source file mtime, size and hash -> slot in the tensor file.
+    # Slots are stable, new pictures are appended, so existing sample indices stay valid
+    manifest_path = os.path.join(os.path.dirname(path), 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path) and os.path.exists(path):
+        with open(manifest_path, 'r') as f:
+            manifest = {int(picture_id): entry for picture_id, entry in json.load(f).items()}
+    elif os.path.exists(path):
+        # Without a manifest the slots of an existing file, e.g. an old full build, are unknown
+        os.remove(path)
 
-    tensors = torch.stack(tensors_list, dim=0)
-    torch.save(tensors, 'data_to_train/tensors.pt')
+    ids = picture_ids(store_path)
+    report = {'added': [], 'modified': [], 'unchanged': [], 'removed': sorted(set(manifest) - set(ids))}
+    if report['removed']:
+        # Removing slots would shift every later sample, rebuild from scratch instead
+        manifest = {}
+        os.remove(path)
+
+    for picture_id in ids:
+        file_path = part_path(picture_id, store_path)
+        stat = os.stat(file_path)
+        entry = manifest.get(picture_id)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            report['unchanged'].append(picture_id)
+            continue
+        sha256 = file_sha256(file_path)
+        if entry is None:
+            report['added'].append(picture_id)
+            manifest[picture_id] = {'slot': len(manifest)}
+        elif entry['sha256'] == sha256:
+            report['unchanged'].append(picture_id)
+        else:
+            report['modified'].append(picture_id)
+        manifest[picture_id].update({'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256})
+
+    to_convert = report['added'] + report['modified']
+    if to_convert:
+        if report['added']:
+            tensors = _grow_tensors(path, len(manifest))
+        else:
+            tensors = np.load(path, mmap_mode = 'r+')
+        df = read_pictures(FEATURE_COLUMNS, ids = to_convert, store_path = store_path)
+        converted = df['picture_id'].unique()
+        pictures = pictures_to_tensor(df)
+        tensors[[manifest[picture_id]['slot'] for picture_id in converted]] = pictures.numpy()
+        tensors.flush()
+        del tensors
+        for picture_id, label in zip(converted, pictures[:, :, :, 0].mean(dim = (1, 2)).tolist()):
+            manifest[int(picture_id)]['label'] = label
+
+    unlabelled = [picture_id for picture_id, entry in manifest.items() if 'label' not in entry]
+    if unlabelled:
+        # Manifests written before the labels were kept, read their slots once
+        tensors = torch.from_numpy(np.load(path, mmap_mode = 'c'))
+        for picture_id in unlabelled:
+            manifest[picture_id]['label'] = tensors[manifest[picture_id]['slot'], :, :, 0].mean().item()
+        del tensors
+
+    slot_ids = sorted(manifest, key = lambda picture_id: manifest[picture_id]['slot'])
+    _write_header(path, (len(manifest), 25, 25, len(FEATURE_COLUMNS)), slot_ids,
+                  [manifest[picture_id]['label'] for picture_id in slot_ids])
+    with open(manifest_path, 'w') as f:
+        json.dump({str(picture_id): manifest[picture_id] for picture_id in slot_ids}, f, indent = 4)
+
+    return report
+
+
+
+def main() -> None:
+    report = convert_incremental('data_to_train/tensors.npy')
+    for status, ids in report.items():
+        print(f"{status}: {len(ids)} pictures" + (f" {ids}" if status in ('added', 'modified', 'removed') and ids else ''))
     print('Tensors saved successfully')
     return
     
@@ -0,0 +1,51 @@
+import time
+import itertools
+from dataclasses import replace
+from src.model import *
+from src.utils import DataLoaderParams, load_params
+
+
+
+def measure_throughput(dataset: Dataset,
+                       params: DataLoaderParams,
+                       batch_augmentation: BatchAugmentation = None,
+                       n_epochs: int = 3) -> float:
+    loader = DataLoader(dataset, batch_size = params.batch_size, shuffle = True, **params.loader_kwargs())
+    if batch_augmentation is not None:
+        loader = AugmentedDataLoader(loader, batch_augmentation)
+
+    # The first epoch warms up the page cache and, with persistent workers, the worker processes
+    for _ in loader:
+        pass
+    n_samples = 0
+    start = time.perf_counter()
+    for _ in range(n_epochs):
+        for inputs, _ in loader:
+            n_samples += inputs.shape[0]
+    return n_samples / (time.perf_counter() - start)
+
+
+
+def main() -> None:
+    params = load_params()
+    base = params.dataloader_params
+    augmentation = params.augmentation_params
+    batch_augmentation = None
+    if augmentation.batched:
+        batch_augmentation = BatchAugmentation(augmentation.degrees, augmentation.translate, augmentation.seed)
+
+    batch_sizes = sorted({base.batch_size, 32, 128})
+    workers = sorted({base.num_workers, 0, 2, 4})
+    print(f"{'dataset':<10} {'batch':>6} {'workers':>8} {'samples/s':>12}")
+    for kind in ['in_memory', 'memmap']:
+        dataset = load_dataset('data_to_train/tensors.npy', kind)
+        for batch_size, num_workers in itertools.product(batch_sizes, workers):
+            setting = replace(base, dataset = kind, batch_size = batch_size, num_workers = num_workers)
+            throughput = measure_throughput(dataset, setting, batch_augmentation)
+            print(f"{kind:<10} {batch_size:>6} {num_workers:>8} {throughput:>12.0f}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,170 @@
 import requests
 import os
-from src.utils import load_yaml
-
-def _download_single_dataset(url: str, output_file: str) -> None:
-    response = requests.get(url, stream = True)
-    response.raise_for_status()
-    with open(output_file, 'wb') as file:
-        for chunk in response.iter_content(chunk_size = 8192):
-            file.write(chunk)
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from src.utils import DownloadParams, file_sha256, load_params
+
+
+
+def make_session(workers: int = 4, retries: int = 5, backoff: float = 0.5) -> requests.Session:
+    # One connection pool shared by every download thread. Failed connections and 429/5xx
+    # responses are retried by urllib3 with exponential backoff
+    retry = Retry(total = retries, backoff_factor = backoff, status_forcelist = (429, 500, 502, 503, 504),
+                  allowed_methods = ['GET'], raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers, max_retries = retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+
+def part_path(output_file: str) -> str:
+    return f"{output_file}.part"
+
+
+
+def _validator(response: requests.Response) -> str | None:
+    # Strong ETag or Last-Modified of the file, weak ETags cannot be used in If-Range
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+
+def _fetch(session: requests.Session, url: str, tmp_path: str, params: DownloadParams) -> None:
+    # Continues the partial file with a Range request. If-Range carries the validator of the file the
+    # partial one was started from, so a server whose file has changed, or that ignores the range,
+    # answers 200 with the whole file, which then replaces the partial one. Partial files without a
+    # validator are started over
+    validator_path = f"{tmp_path}.validator"
+    offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) and os.path.exists(validator_path) else 0
+    headers = {}
+    if offset:
+        with open(validator_path, 'r') as f:
+            headers = {'Range': f"bytes={offset}-", 'If-Range': f.read()}
+    with session.get(url, stream = True, headers = headers, timeout = params.timeout) as response:
+        if response.status_code == 416 and response.headers.get('Content-Range') == f"bytes */{offset}":
+            return
+        response.raise_for_status()
+        resume = (offset > 0 and response.status_code == 206
+                  and response.headers.get('Content-Range', '').startswith(f"bytes {offset}-"))
+        if offset > 0 and response.status_code == 206 and not resume:
+            # Some other range than the one asked for, start over without one
+            os.remove(validator_path)
+            return _fetch(session, url, tmp_path, params)
+        if not resume:
+            validator = _validator(response)
+            if validator is not None:
+                with open(validator_path, 'w') as f:
+                    f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+        with open(tmp_path, 'ab' if resume else 'wb') as file:
+            for chunk in response.iter_content(chunk_size = params.chunk_size):
+                file.write(chunk)
     return
-    
-    
 
-def download_data(urls_dict: dict[str, str]) -> None:
-    for url, output_file in urls_dict.items():
+
+
+def _download_single_dataset(session: requests.Session,
+                             url: str,
+                             output_file: str,
+                             params: DownloadParams = DownloadParams()) -> dict:
+    # Downloads into a .part file that is renamed once complete, so output_file never holds a
+    # truncated download. Interrupted transfers are resumed from the bytes already on disk
+    tmp_path = part_path(output_file)
+    for attempt in range(params.retries + 1):
         try:
-            if os.path.exists(output_file) or os.path.exists(output_file.split('.')[0] + '.geojson'):
-                print(f'The file {output_file} already exists')
+            _fetch(session, url, tmp_path, params)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout):
+            if attempt == params.retries:
+                raise
+            time.sleep(params.backoff * 2 ** attempt)
+
+    entry = {
+        'url': url,
+        'size': os.path.getsize(tmp_path),
+        'sha256': file_sha256(tmp_path, params.chunk_size),
+    }
+    os.replace(tmp_path, output_file)
+    if os.path.exists(f"{tmp_path}.validator"):
+        os.remove(f"{tmp_path}.validator")
+    return entry
+
+
+
+def load_manifest(manifest_path: str) -> dict[str, dict]:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+
+def save_manifest(manifest: dict[str, dict], manifest_path: str) -> None:
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok = True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent = 4, sort_keys = True)
+    os.replace(tmp_path, manifest_path)
+    return
+
+
+
+def is_downloaded(url: str, output_file: str, manifest: dict[str, dict]) -> bool:
+    # Preprocessing converts every download to GeoJSON and rewrites GeoJSON downloads in place when it
+    # reprojects them, so once the GeoJSON exists its size says nothing and it counts as downloaded.
+    # Any other file counts when the manifest has it at its current size
+    if os.path.exists(os.path.splitext(output_file)[0] + '.geojson'):
+        return True
+    entry = manifest.get(output_file)
+    return (entry is not None and entry['url'] == url and os.path.exists(output_file)
+            and os.path.getsize(output_file) == entry['size'])
+
+
+
+def download_data(urls_dict: dict[str, str], params: DownloadParams = DownloadParams()) -> dict[str, dict]:
+    manifest = load_manifest(params.manifest)
+    pending = {}
+    for url, output_file in urls_dict.items():
+        if is_downloaded(url, output_file, manifest):
+            print(f'The file {output_file} already exists')
+        else:
+            pending[url] = output_file
+
+    session = make_session(params.workers, params.retries, params.backoff)
+    with ThreadPoolExecutor(max_workers = params.workers) as executor:
+        futures = {executor.submit(_download_single_dataset, session, url, output_file, params): output_file
+                   for url, output_file in pending.items()}
+        for future in as_completed(futures):
+            output_file = futures[future]
+            try:
+                manifest[output_file] = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f'Failed to download the data to {output_file}: {e}')
                 continue
-            else:
-                _download_single_dataset(url, output_file)
-                print(f'Downloaded the data to {output_file}')
-        except requests.exceptions.HTTPError as e:
-            print(f'Failed to download the data: {e}')
-        finally:
-            continue
+            # Saved after every file, so an interrupted run keeps what it finished
+            save_manifest(manifest, params.manifest)
+            print(f'Downloaded the data to {output_file}')
+    session.close()
     print('Download completed')
-    return
+    return manifest
 
 
 
 def main() -> None:
-    yaml_path = 'params.yaml'
-    urls_dict = load_yaml(yaml_path)['download_data']
-    download_data(urls_dict)
+    params = load_params()
+    download_data(params.download_data, params.download_params)
     return
 
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,125 @@
+import os
+import copy
+import json
+import time
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from src.model import CNNClassifier, DataLoader
+from src.test import evaluate_model, load_data
+from src.utils import load_params
+
+
+
+def fold_batchnorm(model: CNNClassifier) -> CNNClassifier:
+    # Merges every BatchNorm into the preceding convolution, the folded model computes the same
+    # function in eval mode with three fewer layers
+    folded = copy.deepcopy(model).eval()
+    for conv, bn in [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]:
+        setattr(folded, conv, fuse_conv_bn_eval(getattr(folded, conv), getattr(folded, bn)))
+        setattr(folded, bn, nn.Identity())
+    return folded
+
+
+
+def quantize_static(model: nn.Module, calibration_loader: DataLoader, n_batches: int = 16) -> nn.Module:
+    # Post-training int8 quantization of the convolutions and linear layers, activation ranges
+    # are observed on a few calibration batches
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    example_inputs = (next(iter(calibration_loader))[0].float(),)
+    prepared = prepare_fx(copy.deepcopy(model).eval(),
+                          get_default_qconfig_mapping(torch.backends.quantized.engine),
+                          example_inputs)
+    with torch.inference_mode():
+        for inputs, _ in itertools.islice(calibration_loader, n_batches):
+            prepared(inputs.float())
+    return convert_fx(prepared)
+
+
+
+def quantize(model: nn.Module, method: str, calibration_loader: DataLoader, n_batches: int = 16) -> nn.Module:
+    if method == 'static':
+        return quantize_static(model, calibration_loader, n_batches)
+    if method == 'dynamic':
+        return quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype = torch.qint8)
+    if method == 'none':
+        return model
+    raise ValueError(f"Unknown quantization method '{method}', expected 'static', 'dynamic' or 'none'")
+
+
+
+def to_torchscript(model: nn.Module, example_inputs: torch.tensor) -> torch.jit.ScriptModule:
+    with torch.inference_mode():
+        scripted = torch.jit.trace(model.eval(), example_inputs)
+    return torch.jit.freeze(scripted)
+
+
+
+def measure_speed(model: nn.Module, batch_size: int = 256, n_runs: int = 50) -> dict[str, float]:
+    single = torch.rand(1, 6, 25, 25)
+    batch = torch.rand(batch_size, 6, 25, 25)
+    latencies = []
+    with torch.inference_mode():
+        for _ in range(5):
+            model(single)
+            model(batch)
+        for _ in range(n_runs * 4):
+            start = time.perf_counter()
+            model(single)
+            latencies.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            model(batch)
+        elapsed = time.perf_counter() - start
+    return {
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'throughput_samples_per_s': n_runs * batch_size / elapsed,
+    }
+
+
+
+def main() -> None:
+    params = load_params().export_params
+    _, val_loader, test_loader = load_data("data_to_train/tensors.npy")
+    criterion = nn.CrossEntropyLoss()
+
+    model = CNNClassifier(num_classes = 4)
+    model.load_state_dict(torch.load('model/best_model.pth', map_location = 'cpu'))
+    model.eval()
+    folded = fold_batchnorm(model)
+    quantized = quantize(folded, params.quantization, val_loader, params.calibration_batches)
+    exported = to_torchscript(quantized, torch.rand(1, 6, 25, 25))
+    exported.save(params.output)
+
+    # The exported artifact is checked, not the module it was traced from
+    report = {'quantization': params.quantization, 'artifact': params.output}
+    for name, candidate in [('fp32', model), ('folded', folded), ('exported', torch.jit.load(params.output))]:
+        test_loss, test_accuracy = evaluate_model(candidate, test_loader, criterion, "cpu")
+        report[name] = {'test loss': test_loss, 'test accuracy': test_accuracy, **measure_speed(candidate)}
+    report['accuracy drop'] = report['fp32']['test accuracy'] - report['exported']['test accuracy']
+    report['speedup'] = report['exported']['throughput_samples_per_s'] / report['fp32']['throughput_samples_per_s']
+
+    os.makedirs('model/export', exist_ok = True)
+    with open('model/export/report.json', 'w') as f:
+        json.dump(report, f, indent = 4)
+
+    print(f"{'model':<10} {'accuracy':>9} {'p50 ms':>8} {'p99 ms':>8} {'samples/s':>10}")
+    for name in ['fp32', 'folded', 'exported']:
+        row = report[name]
+        print(f"{name:<10} {row['test accuracy']:>9.4f} {row['latency_p50_ms']:>8.3f} "
+              f"{row['latency_p99_ms']:>8.3f} {row['throughput_samples_per_s']:>10.0f}")
+    if report['accuracy drop'] > params.max_accuracy_drop:
+        raise RuntimeError(f"Exported model loses {report['accuracy drop']:.4f} test accuracy, "
+                           f"more than the allowed {params.max_accuracy_drop}")
+    print(f"Exported model saved to {params.output}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
+import os
 import pandas as pd
 import geopandas as gpd
 import folium
 import branca.colormap as cmp
 from utils import *
 from plots import *
+from src.layers import read_layer
+from src.picture_store import STORE_PATH, read_pictures
 
 
 
@@ -11,7 +14,7 @@ from plots import *
 def noise_map() -> None:
     m = folium.Map(location = [50.08804, 14.42076], zoom_start = 12)
     
-    NOISE = gpd.read_file('data/NOISE.geojson')
+    NOISE = read_layer('noise', ['DB_LO', 'DB_HI'])
     NOISE = pd.concat([NOISE.iloc[[-1]], NOISE.iloc[:-1]]).reset_index(drop = True)
     NOISE.geometry = NOISE.geometry.simplify(tolerance = 150, preserve_topology = True)
     folium.GeoJson(
@@ -28,7 +31,7 @@ def noise_map() -> None:
     )
     m.add_child(step)
     
-    PARKS = gpd.read_file('data/PARKS.geojson')
+    PARKS = read_layer('parks', ['NAZEV'])
     folium.GeoJson(
         PARKS,
         name = 'Parks',
@@ -39,7 +42,7 @@ def noise_map() -> None:
         tooltip = folium.GeoJsonTooltip(fields = ['NAZEV'], aliases = ['Park name']),
     ).add_to(m)
 
-    DEMOGRAPHY = gpd.read_file('data/DEMOGRAPHY.geojson')
+    DEMOGRAPHY = read_layer('population', ['region_id', 'population'])
     folium.GeoJson(
         DEMOGRAPHY,
         name = 'Population',
@@ -50,7 +53,7 @@ def noise_map() -> None:
         tooltip = folium.GeoJsonTooltip(fields = ['region_id', 'population'], aliases = ['region_id', 'population']),
     ).add_to(m)
     
-    DISTRICTS = gpd.read_file('data/DISTRICTS.geojson')
+    DISTRICTS = read_layer('districts', ['NAZEV_MC'])
     folium.GeoJson(
         DISTRICTS,
         name = 'Districts',
@@ -61,7 +64,7 @@ def noise_map() -> None:
         tooltip = folium.GeoJsonTooltip(fields = ['NAZEV_MC'], aliases = ['District name']),
     ).add_to(m)
     
-    ROADS = gpd.read_file('data/ROADS.geojson')
+    ROADS = read_layer('roads', ['maxspeed'])
     folium.GeoJson(
         ROADS,
         name = 'Roads',
@@ -71,7 +74,7 @@ def noise_map() -> None:
         tooltip = folium.GeoJsonTooltip(fields = ['maxspeed'], aliases = ['Speed limit']),
     ).add_to(m)
     
-    BUILDINGS = gpd.read_file('data/BUILDINGS.geojson')
+    BUILDINGS = read_layer('buildings', ['buildings_levels'])
     folium.GeoJson(
         BUILDINGS,
         name = 'Buildings',
@@ -84,10 +87,8 @@ def noise_map() -> None:
     
     
     
-    NOISE_BARRIERS_1 = gpd.read_file('data/NOISE_BARRIERS.geojson')
-    NOISE_BARRIERS_2 = gpd.read_file('data/NOISE_BARRIERS_2.geojson')
-    NOISE_BARRIERS_1.drop(columns = 'ID_CLONA', inplace = True)
-    NOISE_BARRIERS_2.drop(columns = 'ID_VAL', inplace = True)
+    NOISE_BARRIERS_1 = read_layer('noise_barriers_1', [])
+    NOISE_BARRIERS_2 = read_layer('noise_barriers_2', [])
     NOISE_BARRIERS = pd.concat([NOISE_BARRIERS_1, NOISE_BARRIERS_1]).reset_index(drop = True)
     folium.GeoJson(
         NOISE_BARRIERS,
@@ -99,6 +100,19 @@ def noise_map() -> None:
     ).add_to(m)
     
     
+    if os.path.exists(STORE_PATH):
+        PICTURES = gpd.read_file('data/S2_GRID.geojson')
+        picture_noise = read_pictures(['weighted_db_hi']).groupby('picture_id')['weighted_db_hi'].mean()
+        PICTURES['mean_db_hi'] = picture_noise.reindex(PICTURES.index)
+        PICTURES = PICTURES[PICTURES['mean_db_hi'].notna()]
+        folium.GeoJson(
+            PICTURES,
+            name = 'Aggregated noise',
+            style_function = lambda feature: style_function(feature, PICTURES, 'mean_db_hi', 'turbo'),
+            tooltip = folium.GeoJsonTooltip(fields = ['mean_db_hi'], aliases = ['Mean DB_HI']),
+        ).add_to(m)
+    
+    
     folium.LayerControl().add_to(m)
     m.save("maps/prague_map.html")
     return
@@ -0,0 +1,46 @@
+import os
+import geopandas as gpd
+from src.preprocessing import convert_layer
+
+
+
+# Every source layer by name. All of them are read from their repaired GeoParquet copy,
+# see preprocessing.convert_layer
+CATALOGUE = {
+    'noise': 'NOISE.geojson',
+    'transport_lines': 'TRANSPORT_LINES.geojson',
+    'noise_barriers_1': 'NOISE_BARRIERS.geojson',
+    'noise_barriers_2': 'NOISE_BARRIERS_2.geojson',
+    'parks': 'PARKS.geojson',
+    'buildings': 'BUILDINGS.geojson',
+    'population': 'DEMOGRAPHY.geojson',
+    'roads': 'ROADS.geojson',
+    'districts': 'DISTRICTS.geojson',
+}
+
+# Layers already read in this process, keyed by the file and the read options
+_loaded = {}
+
+
+
+def layer_path(name: str, data_dir: str = 'data') -> str:
+    if name not in CATALOGUE:
+        raise KeyError(f"Unknown layer '{name}', expected one of {list(CATALOGUE)}")
+    return os.path.join(data_dir, CATALOGUE[name])
+
+
+
+def read_layer(name: str,
+               columns: list[str] = None,
+               bbox: tuple[float, float, float, float] = None,
+               data_dir: str = 'data') -> gpd.GeoDataFrame:
+    # Only the given attribute columns and the features whose bounding box intersects bbox are read.
+    # Every read is memoized for the process until the copy on disk changes, callers get their own
+    # copy and are free to modify it
+    path = convert_layer(layer_path(name, data_dir))
+    key = (path, None if columns is None else tuple(columns), None if bbox is None else tuple(bbox))
+    mtime = os.path.getmtime(path)
+    if key not in _loaded or _loaded[key][0] != mtime:
+        gdf = gpd.read_parquet(path, columns = None if columns is None else list(columns) + ['geometry'], bbox = bbox)
+        _loaded[key] = (mtime, gdf)
+    return _loaded[key][1].copy()
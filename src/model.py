@@ -1,12 +1,13 @@
+import os
+import json
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, TensorDataset, Dataset, random_split
+from torch.utils.data import DataLoader, TensorDataset, Dataset, Subset
 import torchvision
 from tqdm import tqdm
-from sklearn.metrics import accuracy_score
 
 
 
@@ -24,60 +25,239 @@ class TransformedDataset(Dataset):
         return x, y
 
 
-def get_data(data: torch.tensor) -> tuple[list, list]:
-    features_list = []
-    labels_list = []
+class BatchAugmentation:
+    # Random horizontal flip, rotation and translation of a whole (N, C, H, W) batch in a
+    # single affine_grid/grid_sample call, the batched counterpart of the torchvision Compose
+    def __init__(self, degrees: float = 15, translate: float = 0.1, seed: int = None):
+        self.degrees = degrees
+        self.translate = translate
+        self.generator = torch.Generator()
+        # A fresh Generator always starts from the same default seed, so without a seed it is drawn from the OS
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
 
-    for i in range(data.shape[0]):
-        feature_map = data[i, :, :, 1:].permute(2, 0, 1)
-        labels = data[i, :, :, 0]
-        label = labels.mean()
-        features_list.append(feature_map)
-        labels_list.append(label)
-    
-    q25 = np.quantile(labels_list, 0.25)
-    q50 = np.quantile(labels_list, 0.5)
-    q75 = np.quantile(labels_list, 0.75)
+    def __call__(self, x: torch.tensor) -> torch.tensor:
+        n = x.shape[0]
+        flip = torch.where(torch.rand(n, generator = self.generator) < 0.5, -1.0, 1.0)
+        angle = torch.deg2rad((torch.rand(n, generator = self.generator) * 2 - 1) * self.degrees)
+        # Shift of up to translate * side length, the normalized grid spans 2 units per side
+        shift = (torch.rand(n, 2, generator = self.generator) * 2 - 1) * self.translate * 2
+
+        # Output pixel p samples the input at flip(rotation^-1(p - shift))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        linear = torch.stack([torch.stack([flip * cos, flip * sin], dim = 1),
+                              torch.stack([-sin, cos], dim = 1)], dim = 1)
+        offset = -(linear @ shift.unsqueeze(2))
+        theta = torch.cat([linear, offset], dim = 2)
+
+        grid = F.affine_grid(theta, list(x.shape), align_corners = False)
+        return F.grid_sample(x.float(), grid, mode = 'nearest', padding_mode = 'zeros', align_corners = False)
+
+
+
+class AugmentedDataLoader:
+    def __init__(self, dataloader: DataLoader, augmentation: BatchAugmentation):
+        self.dataloader = dataloader
+        self.augmentation = augmentation
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for inputs, labels in self.dataloader:
+            yield self.augmentation(inputs), labels
+
+
+
+def quantize_labels(labels: torch.tensor) -> torch.tensor:
+    # Quartile classes: 0 for values <= q25, 1 for <= q50, 2 for <= q75, 3 above
+    quantiles = np.quantile(labels.numpy(), [0.25, 0.5, 0.75])
+    return torch.bucketize(labels, torch.tensor(quantiles, dtype = labels.dtype))
+
+
+
+def get_data(data: torch.tensor) -> tuple[torch.tensor, torch.tensor]:
+    features = data[:, :, :, 1:].permute(0, 3, 1, 2).contiguous()
+    labels = data[:, :, :, 0].mean(dim = (1, 2))
+    quantized_labels = quantize_labels(labels)
     
-    def quantize(value: float) -> int:
-        if value <= q25:
-            return 0
-        elif value <= q50:
-            return 1
-        elif value <= q75:
-            return 2
+    return features, quantized_labels
+
+
+
+def load_tensors(path: str = 'data_to_train/tensors.npy') -> torch.tensor:
+    # Copy-on-write memory map, pages are read from disk only when they are accessed
+    return torch.from_numpy(np.load(path, mmap_mode = 'c'))
+
+
+
+class MemmapDataset(Dataset):
+    def __init__(self, path: str = 'data_to_train/tensors.npy'):
+        with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+            self.header = json.load(f)
+        self.data = load_tensors(path)
+        self.picture_ids = self.header['picture_ids']
+        if 'labels' in self.header:
+            self.labels = quantize_labels(torch.tensor(self.header['labels'], dtype = self.data.dtype))
         else:
-            return 3
-    
-    quantized_labels = [quantize(x) for x in labels_list]
-    
-    return features_list, quantized_labels
+            # Headers written before the labels were kept
+            self.labels = quantize_labels(self.data[:, :, :, 0].mean(dim = (1, 2)))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, idx):
+        # Zero-copy view of the mapped sample, same layout as the features from get_data
+        return self.data[idx, :, :, 1:].permute(2, 0, 1), self.labels[idx]
+
+
+
+class MosaicDataset(Dataset):
+    # Windows of the city mosaic written by src/mosaic.py, one per S2 picture unless other
+    # (row, col) offsets are given. Samples are views into the mapped raster, nothing is copied
+    def __init__(self, path: str = 'data/mosaic.npy', offsets: list[tuple[int, int]] = None):
+        with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+            self.header = json.load(f)
+        self.data = torch.from_numpy(np.load(path, mmap_mode = 'c'))
+        self.size = self.header['picture_size']
+        # Windows at other offsets than the pictures are split by index
+        self.picture_ids = None
+        if offsets is None:
+            pictures = self.header['pictures']
+            self.picture_ids = sorted(map(int, pictures))
+            offsets = [tuple(pictures[str(picture_id)]) for picture_id in self.picture_ids]
+        self.offsets = offsets
+        if self.picture_ids is not None and 'labels' in self.header:
+            labels = torch.tensor([self.header['labels'][str(picture_id)] for picture_id in self.picture_ids],
+                                  dtype = self.data.dtype)
+        else:
+            labels = torch.stack([self.window(idx)[0].mean() for idx in range(len(self))])
+        self.labels = quantize_labels(labels)
 
+    def window(self, idx):
+        row, col = self.offsets[idx]
+        return self.data[:, row:row + self.size, col:col + self.size]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        return self.window(idx)[1:], self.labels[idx]
 
 
-def create_dataset(features_list: list, labels_list: list) -> TensorDataset:
-    labels = torch.tensor(labels_list)
-    features = torch.stack(features_list)
+
+def create_dataset(features: torch.tensor, labels: torch.tensor) -> TensorDataset:
     dataset = TensorDataset(features, labels)
     return dataset
 
 
-def train_val_test_split(dataset: TensorDataset) -> tuple[TensorDataset, TensorDataset, TensorDataset]:
-    return random_split(dataset, [0.7, 0.2, 0.1])
+SPLIT_FRACTIONS = {'train': 0.7, 'val': 0.2, 'test': 0.1}
+
+
+def _draw_split(ids: np.ndarray, generator: torch.Generator) -> dict[str, np.ndarray]:
+    # Same draw as random_split with fractional lengths, which warns about the empty subsets a
+    # handful of new pictures gives
+    lengths = np.floor(np.array(list(SPLIT_FRACTIONS.values())) * len(ids)).astype(int)
+    lengths[:len(ids) - lengths.sum()] += 1
+    order = ids[torch.randperm(len(ids), generator = generator).numpy()]
+    return dict(zip(SPLIT_FRACTIONS, np.split(order, np.cumsum(lengths)[:-1])))
+
+
+def train_val_test_split(dataset: Dataset, 
+                         split_path: str = None, 
+                         seed: int = 42) -> tuple[Dataset, Dataset, Dataset]:
+    # The split is saved as picture ids, so training and testing see the same held-out pictures however
+    # the slots of the dataset are laid out. Pictures new to the dataset are drawn into the split with
+    # the seeded generator, pictures already assigned keep their subset. Datasets without picture ids
+    # are split by sample index
+    ids = getattr(dataset, 'picture_ids', None)
+    ids = np.arange(len(dataset)) if ids is None else np.asarray(ids)
+    generator = torch.Generator().manual_seed(seed)
+
+    split = {name: ids[:0] for name in SPLIT_FRACTIONS}
+    changed = False
+    if split_path is not None and os.path.exists(split_path):
+        saved = np.load(split_path)
+        if 'train_ids' in saved:
+            split = {name: saved[f"{name}_ids"] for name in SPLIT_FRACTIONS}
+        elif sum(len(saved[name]) for name in SPLIT_FRACTIONS) == len(dataset):
+            # Index split from before picture ids were saved, valid as long as the slots are unchanged
+            split = {name: ids[saved[name]] for name in SPLIT_FRACTIONS}
+            changed = True
+        else:
+            raise ValueError(f"{split_path} holds a sample index split of a different dataset size, "
+                             f"the held-out pictures cannot be recovered")
+    assigned = np.concatenate(list(split.values()))
+    missing = np.setdiff1d(assigned, ids)
+    if len(missing):
+        raise ValueError(f"{split_path} assigns {len(missing)} pictures that are not in the dataset, "
+                         f"e.g. {missing[:5].tolist()}")
+
+    new = ids[~np.isin(ids, assigned)]
+    if len(new):
+        drawn = _draw_split(new, generator)
+        split = {name: np.concatenate([split[name], drawn[name]]) for name in SPLIT_FRACTIONS}
+        changed = True
+    if changed and split_path is not None:
+        np.savez(split_path, **{f"{name}_ids": split[name] for name in SPLIT_FRACTIONS})
+
+    position = {picture_id: i for i, picture_id in enumerate(ids.tolist())}
+    return tuple(Subset(dataset, [position[picture_id] for picture_id in split[name].tolist()])
+                 for name in SPLIT_FRACTIONS)
 
 
-def create_dataloaders(features_list: list, 
-                       labels_list: list,
+def split_path(path: str = 'data_to_train/tensors.npy') -> str:
+    return os.path.join(os.path.dirname(path), 'split.npz')
+
+
+
+def load_dataset(path: str = 'data_to_train/tensors.npy', kind: str = 'memmap') -> Dataset:
+    if kind == 'memmap':
+        return MemmapDataset(path)
+    elif kind == 'in_memory':
+        features, labels = get_data(load_tensors(path))
+        dataset = create_dataset(features, labels)
+        with open(os.path.splitext(path)[0] + '.json', 'r') as f:
+            dataset.picture_ids = json.load(f)['picture_ids']
+        return dataset
+    elif kind == 'mosaic':
+        return MosaicDataset(path)
+    raise ValueError(f"Unknown dataset kind: {kind}, expected 'memmap', 'in_memory' or 'mosaic'")
+
+
+
+def create_dataloaders(features: torch.tensor, 
+                       labels: torch.tensor,
                        transform: torchvision.transforms, 
-                       batch_size: int = 32) -> tuple[DataLoader, DataLoader, DataLoader]:
-    dataset = create_dataset(features_list, labels_list)
-    train_dataset, val_dataset, test_dataset = train_val_test_split(dataset)
-    train_dataset = TransformedDataset(train_dataset, transform)
-
-    batch_size = 32
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
+                       batch_size: int = 32,
+                       batch_augmentation: BatchAugmentation = None,
+                       split_path: str = None,
+                       seed: int = 42,
+                       **loader_kwargs) -> tuple[DataLoader, DataLoader, DataLoader]:
+    dataset = create_dataset(features, labels)
+    return split_dataloaders(dataset, transform, batch_size, batch_augmentation, split_path, seed, **loader_kwargs)
+
+
+
+def split_dataloaders(dataset: Dataset,
+                      transform: torchvision.transforms, 
+                      batch_size: int = 32,
+                      batch_augmentation: BatchAugmentation = None,
+                      split_path: str = None,
+                      seed: int = 42,
+                      **loader_kwargs) -> tuple[DataLoader, DataLoader, DataLoader]:
+    train_dataset, val_dataset, test_dataset = train_val_test_split(dataset, split_path, seed)
+    if batch_augmentation is None:
+        train_dataset = TransformedDataset(train_dataset, transform)
+
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+    
+    if batch_augmentation is not None:
+        train_loader = AugmentedDataLoader(train_loader, batch_augmentation)
     
     return train_loader, val_loader, test_loader
     
@@ -101,7 +281,7 @@ class CNNClassifier(nn.Module):
         x = self.pool(F.relu(self.bn1(self.conv1(x))))  # (16, 12, 12)
         x = self.pool(F.relu(self.bn2(self.conv2(x))))  # (32, 6, 6)
         x = self.pool(F.relu(self.bn3(self.conv3(x))))  # (64, 3, 3)
-        x = x.view(-1, 64 * 3 * 3)
+        x = x.reshape(-1, 64 * 3 * 3)
         x = F.relu(self.fc1(x))
         x = self.dropout(x)
         x = self.fc2(x)
@@ -109,64 +289,107 @@ class CNNClassifier(nn.Module):
 
 
 
+class FullyConvolutionalClassifier(nn.Module):
+    # CNNClassifier with fc1 as a 3x3 and fc2 as a 1x1 convolution. On a 25x25 picture it gives the
+    # same logits, on a larger raster it scores every 24x24 window at a stride of 8 pixels in one pass
+    def __init__(self, classifier: CNNClassifier) -> None:
+        super(FullyConvolutionalClassifier, self).__init__()
+        self.features = nn.Sequential(
+            classifier.conv1, classifier.bn1, nn.ReLU(), classifier.pool,
+            classifier.conv2, classifier.bn2, nn.ReLU(), classifier.pool,
+            classifier.conv3, classifier.bn3, nn.ReLU(), classifier.pool,
+        )
+        fc1, fc2 = classifier.fc1, classifier.fc2
+        self.conv_fc1 = nn.Conv2d(64, fc1.out_features, kernel_size = 3)
+        self.conv_fc2 = nn.Conv2d(fc2.in_features, fc2.out_features, kernel_size = 1)
+        with torch.no_grad():
+            # fc1 reads the (64, 3, 3) feature map flattened in channel, row, column order
+            self.conv_fc1.weight.copy_(fc1.weight.view(fc1.out_features, 64, 3, 3))
+            self.conv_fc1.bias.copy_(fc1.bias)
+            self.conv_fc2.weight.copy_(fc2.weight.view(fc2.out_features, fc2.in_features, 1, 1))
+            self.conv_fc2.bias.copy_(fc2.bias)
+        self.eval()
+
+    def forward(self, x: torch.tensor) -> torch.tensor:
+        x = self.features(x)
+        x = F.relu(self.conv_fc1(x))
+        return self.conv_fc2(x)
+
+
+
+def _to_device(inputs: torch.tensor, 
+               labels: torch.tensor, 
+               device: str, 
+               channels_last: bool) -> tuple[torch.tensor, torch.tensor]:
+    inputs, labels = inputs.float().to(device, non_blocking = True), labels.to(device, non_blocking = True)
+    if channels_last:
+        inputs = inputs.contiguous(memory_format = torch.channels_last)
+    return inputs, labels
+
+
+
 def _train(model: CNNClassifier, 
            dataloader: DataLoader,
            criterion: nn.CrossEntropyLoss, 
            optimizer: torch.optim, 
-           device: str) -> tuple[float, float]:
+           device: str,
+           channels_last: bool = False,
+           autocast: bool = False) -> tuple[float, float]:
     
     model.train()
-    total_loss = 0
-    all_preds = []
-    all_labels = []
+    # Running sums stay on the device, the host syncs once per epoch
+    total_loss = torch.zeros((), dtype = torch.float64, device = device)
+    correct = torch.zeros((), dtype = torch.long, device = device)
+    n_samples = 0
 
     for inputs, labels in tqdm(dataloader, desc = "Training", leave = False):
-        inputs, labels = inputs.float().to(device), labels.to(device)
+        inputs, labels = _to_device(inputs, labels, device, channels_last)
 
         # Forward
-        outputs = model(inputs)
-        loss = criterion(outputs, labels)
+        with torch.autocast(torch.device(device).type, dtype = torch.bfloat16, enabled = autocast):
+            outputs = model(inputs)
+            loss = criterion(outputs, labels)
 
         # Backward
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none = True)
         loss.backward()
         optimizer.step()
 
-        total_loss += loss.item()
-        all_preds.extend(torch.argmax(outputs, dim = 1).cpu().numpy())
-        all_labels.extend(labels.cpu().numpy())
-
-    accuracy = accuracy_score(all_labels, all_preds)
+        total_loss += loss.detach()
+        correct += (torch.argmax(outputs, dim = 1) == labels).sum()
+        n_samples += labels.shape[0]
 
-    return total_loss / len(dataloader), accuracy
+    return total_loss.item() / len(dataloader), correct.item() / n_samples
 
 
 
 def _validate(model: CNNClassifier, 
               dataloader: DataLoader,
               criterion: nn.CrossEntropyLoss,
-              device: str) -> tuple[float, float]:
+              device: str,
+              channels_last: bool = False,
+              autocast: bool = False,
+              desc: str = "Validation") -> tuple[float, float]:
     
     model.eval()
-    total_loss = 0
-    all_preds = []
-    all_labels = []
+    total_loss = torch.zeros((), dtype = torch.float64, device = device)
+    correct = torch.zeros((), dtype = torch.long, device = device)
+    n_samples = 0
 
-    with torch.no_grad():
-        for inputs, labels in tqdm(dataloader, desc = "Validation", leave = False):
-            inputs, labels = inputs.float().to(device), labels.to(device)
+    with torch.inference_mode():
+        for inputs, labels in tqdm(dataloader, desc = desc, leave = False):
+            inputs, labels = _to_device(inputs, labels, device, channels_last)
 
             # Forward
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-
-            total_loss += loss.item()
-            all_preds.extend(torch.argmax(outputs, dim = 1).cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
+            with torch.autocast(torch.device(device).type, dtype = torch.bfloat16, enabled = autocast):
+                outputs = model(inputs)
+                loss = criterion(outputs, labels)
 
-    accuracy = accuracy_score(all_labels, all_preds)
+            total_loss += loss.detach()
+            correct += (torch.argmax(outputs, dim = 1) == labels).sum()
+            n_samples += labels.shape[0]
     
-    return total_loss / len(dataloader), accuracy
+    return total_loss.item() / len(dataloader), correct.item() / n_samples
 
 
 
@@ -178,8 +401,15 @@ def train_model(model: CNNClassifier,
                 train_loader: DataLoader, 
                 test_loader: DataLoader, 
                 device: str, 
-                patience: int = np.inf) -> tuple:
+                patience: int = np.inf,
+                compile: bool = False,
+                channels_last: bool = False,
+                autocast: bool = False) -> tuple:
     
+    if channels_last:
+        model = model.to(memory_format = torch.channels_last)
+    # The compiled wrapper shares parameters with model, checkpoints are saved from model itself
+    run_model = torch.compile(model) if compile else model
     train_losses = []
     val_losses = []
     train_accs = []
@@ -190,8 +420,8 @@ def train_model(model: CNNClassifier,
     is_quit = 0
     
     for epoch in range(num_epochs):
-        train_loss, train_acc = _train(model, train_loader, criterion, optimizer, device)
-        val_loss, val_acc = _validate(model, test_loader, criterion, device)
+        train_loss, train_acc = _train(run_model, train_loader, criterion, optimizer, device, channels_last, autocast)
+        val_loss, val_acc = _validate(run_model, test_loader, criterion, device, channels_last, autocast)
         train_losses.append(train_loss)
         val_losses.append(val_loss)
         train_accs.append(train_acc)
@@ -0,0 +1,253 @@
+import os
+import json
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+from affine import Affine
+from tqdm import tqdm
+from src.aggregation import aggregate_pixels, layers_for_area, load_layers
+from src.convert_to_tensor import pictures_to_tensor
+from src.picture_store import FEATURE_COLUMNS, STORE_PATH, picture_ids, read_pictures
+from src.rasterize import rasterize_mosaic
+from src.utils import load_params
+
+
+
+PIXELS_ON_SIDE = 25
+
+
+
+def grid_transform(grid: gpd.GeoDataFrame) -> tuple[Affine, int, int]:
+    # Affine transform of the pixel raster covering the whole S2 grid, anchored at its north-west corner.
+    # get_squares_from_rect stretches the cells to split the city envelope evenly, so they are rarely
+    # exactly side_length wide and the pixel size is taken from the cells themselves
+    bounds = grid.bounds
+    pixel_width = np.median(bounds['maxx'] - bounds['minx']) / PIXELS_ON_SIDE
+    pixel_height = np.median(bounds['maxy'] - bounds['miny']) / PIXELS_ON_SIDE
+    minx, miny, maxx, maxy = grid.total_bounds
+    height = int(round((maxy - miny) / pixel_height))
+    width = int(round((maxx - minx) / pixel_width))
+    return Affine(pixel_width, 0, minx, 0, -pixel_height, maxy), height, width
+
+
+
+def picture_offsets(grid: gpd.GeoDataFrame, transform: Affine) -> dict[int, tuple[int, int]]:
+    # Row and column of the north-west pixel of every picture in the mosaic
+    bounds = grid.bounds
+    rows = np.round((transform.f - bounds['maxy'].values) / -transform.e).astype(int)
+    cols = np.round((bounds['minx'].values - transform.c) / transform.a).astype(int)
+    return {int(picture_id): (int(row), int(col)) for picture_id, row, col in zip(grid.index, rows, cols)}
+
+
+
+def lattice_pixels(picture, size: int = PIXELS_ON_SIDE) -> gpd.GeoDataFrame:
+    # Pixels of a picture in row-major order from the north-west corner. The edges are the same
+    # linspace values get_squares_from_rect gives aggregate_picture, so both aggregate identical pixels
+    minx, miny, maxx, maxy = picture.bounds
+    xedges = np.linspace(minx, maxx, size + 1)
+    yedges = np.linspace(miny, maxy, size + 1)[::-1]
+    xmin, ymax = np.meshgrid(xedges[:-1], yedges[:-1])
+    xmax, ymin = np.meshgrid(xedges[1:], yedges[1:])
+    boxes = shapely.box(xmin.ravel(), ymin.ravel(), xmax.ravel(), ymax.ravel())
+    return gpd.GeoDataFrame(geometry = boxes, crs = 'EPSG:5514')
+
+
+
+_worker_layers = None
+
+
+def _init_worker(layers: dict[str, gpd.GeoDataFrame]) -> None:
+    global _worker_layers
+    _worker_layers = layers
+    return
+
+
+def _aggregate_block(task: tuple) -> tuple[int, np.ndarray]:
+    picture_id, picture = task
+    pixels = aggregate_pixels(lattice_pixels(picture), layers_for_area(_worker_layers, picture))
+    values = pixels[FEATURE_COLUMNS].apply(pd.to_numeric, errors = 'coerce').fillna(0).to_numpy(dtype = np.float32)
+    return picture_id, values.T.reshape(len(FEATURE_COLUMNS), PIXELS_ON_SIDE, PIXELS_ON_SIDE)
+
+
+
+def load_mosaic_layers() -> dict[str, gpd.GeoDataFrame]:
+    # Layers with their spatial index built up front, so forked workers inherit it
+    layers = load_layers()
+    for layer in layers.values():
+        layer.sindex
+    return layers
+
+
+
+def aggregate_mosaic(grid: gpd.GeoDataFrame,
+                     workers: int = 1,
+                     layers: dict[str, gpd.GeoDataFrame] = None) -> tuple[np.ndarray, Affine, dict[int, tuple[int, int]]]:
+    # Aggregates every picture straight into one (channels, height, width) raster on a single pixel
+    # lattice, the layers are indexed once instead of being clipped to each picture.
+    # Pixels outside the grid are NaN
+    transform, height, width = grid_transform(grid)
+    offsets = picture_offsets(grid, transform)
+    mosaic = np.full((len(FEATURE_COLUMNS), height, width), np.nan, dtype = np.float32)
+    tasks = list(grid.geometry.items())
+
+    layers = load_mosaic_layers() if layers is None else layers
+    if workers == 1:
+        _init_worker(layers)
+        blocks = map(_aggregate_block, tasks)
+    else:
+        context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        pool = context.Pool(workers, initializer = _init_worker, initargs = (layers,))
+        blocks = pool.imap_unordered(_aggregate_block, tasks, chunksize = 1)
+    for picture_id, block in tqdm(blocks, total = len(tasks), desc = f"Mosaic aggregation ({workers} workers)"):
+        row, col = offsets[picture_id]
+        mosaic[:, row:row + PIXELS_ON_SIDE, col:col + PIXELS_ON_SIDE] = block
+    if workers != 1:
+        pool.close()
+        pool.join()
+    return mosaic, transform, offsets
+
+
+
+def rasterize_grid(grid: gpd.GeoDataFrame,
+                   supersample: int = 8,
+                   layers: dict[str, gpd.GeoDataFrame] = None) -> tuple[np.ndarray, Affine, dict[int, tuple[int, int]]]:
+    # Approximate counterpart of aggregate_mosaic, see rasterize_mosaic
+    transform, height, width = grid_transform(grid)
+    offsets = picture_offsets(grid, transform)
+    layers = load_mosaic_layers() if layers is None else layers
+    mosaic = rasterize_mosaic(layers, transform, height, width, supersample)
+    inside = np.zeros((height, width), dtype = bool)
+    for row, col in offsets.values():
+        inside[row:row + PIXELS_ON_SIDE, col:col + PIXELS_ON_SIDE] = True
+    mosaic[:, ~inside] = np.nan
+    return mosaic, transform, offsets
+
+
+
+def mosaic_from_store(grid: gpd.GeoDataFrame,
+                      store_path: str = STORE_PATH) -> tuple[np.ndarray, Affine, dict[int, tuple[int, int]]]:
+    # Places the pictures already in the picture store at their position in the mosaic,
+    # pictures missing from the store stay NaN
+    transform, height, width = grid_transform(grid)
+    offsets = picture_offsets(grid, transform)
+    mosaic = np.full((len(FEATURE_COLUMNS), height, width), np.nan, dtype = np.float32)
+    ids = picture_ids(store_path)
+    pictures = pictures_to_tensor(read_pictures(ids = ids, store_path = store_path)).numpy()
+    for picture_id, picture in zip(ids, pictures):
+        row, col = offsets[picture_id]
+        mosaic[:, row:row + PIXELS_ON_SIDE, col:col + PIXELS_ON_SIDE] = picture.transpose(2, 0, 1)
+    return mosaic, transform, {picture_id: offsets[picture_id] for picture_id in ids}
+
+
+
+def header_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.json'
+
+
+
+def save_mosaic(mosaic: np.ndarray,
+                transform: Affine,
+                offsets: dict[int, tuple[int, int]],
+                path: str) -> None:
+    header = {
+        'shape': list(mosaic.shape),
+        'dtype': 'float32',
+        'channels': FEATURE_COLUMNS,
+        'crs': 'EPSG:5514',
+        'transform': list(transform)[:6],
+        'picture_size': PIXELS_ON_SIDE,
+        'pictures': {str(picture_id): list(offset) for picture_id, offset in sorted(offsets.items())},
+        # Mean noise of every picture window, so the dataset never reads the whole raster to label it
+        'labels': {str(picture_id): float(mosaic[0, row:row + PIXELS_ON_SIDE, col:col + PIXELS_ON_SIDE].mean())
+                   for picture_id, (row, col) in sorted(offsets.items())},
+    }
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, mosaic)
+    os.replace(tmp_path, path)
+    with open(header_path(path), 'w') as f:
+        json.dump(header, f, indent = 4)
+    return
+
+
+
+def load_mosaic(path: str) -> tuple[np.ndarray, dict]:
+    # Read-only memory map, pictures and windows sliced from it do not copy any data
+    with open(header_path(path), 'r') as f:
+        header = json.load(f)
+    header['transform'] = Affine(*header['transform'])
+    header['pictures'] = {int(picture_id): tuple(offset) for picture_id, offset in header['pictures'].items()}
+    if 'labels' in header:
+        header['labels'] = {int(picture_id): label for picture_id, label in header['labels'].items()}
+    return np.load(path, mmap_mode = 'r'), header
+
+
+
+def picture_view(mosaic: np.ndarray, header: dict, picture_id: int) -> np.ndarray:
+    row, col = header['pictures'][picture_id]
+    size = header['picture_size']
+    return mosaic[:, row:row + size, col:col + size]
+
+
+
+def window_offsets(mosaic: np.ndarray, stride: int, size: int = PIXELS_ON_SIDE) -> list[tuple[int, int]]:
+    # Offsets of every size x size window on a stride x stride lattice that lies fully inside the grid,
+    # for sampling training windows beyond the fixed picture positions
+    valid = ~np.isnan(mosaic[0])
+    integral = np.pad(valid.cumsum(axis = 0).cumsum(axis = 1), ((1, 0), (1, 0)))
+    rows, cols = np.meshgrid(np.arange(0, valid.shape[0] - size + 1, stride),
+                             np.arange(0, valid.shape[1] - size + 1, stride), indexing = 'ij')
+    n_valid = (integral[rows + size, cols + size] - integral[rows, cols + size]
+               - integral[rows + size, cols] + integral[rows, cols])
+    keep = n_valid == size * size
+    return list(zip(rows[keep].tolist(), cols[keep].tolist()))
+
+
+
+def write_geotiff(mosaic: np.ndarray, transform: Affine, path: str) -> None:
+    profile = {
+        'driver': 'GTiff',
+        'height': mosaic.shape[1],
+        'width': mosaic.shape[2],
+        'count': mosaic.shape[0],
+        'dtype': 'float32',
+        'crs': 'EPSG:5514',
+        'transform': transform,
+        'nodata': np.nan,
+        'compress': 'deflate',
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(mosaic)
+        for band, name in enumerate(FEATURE_COLUMNS, start = 1):
+            dst.set_band_description(band, name)
+    return
+
+
+
+def main() -> None:
+    params = load_params()
+    mosaic_params = params.mosaic_params
+    grid = gpd.read_file("data/S2_GRID.geojson")
+
+    aggregation_params = params.aggregation_params
+    if mosaic_params.source == 'layers' and aggregation_params.backend == 'raster':
+        mosaic, transform, offsets = rasterize_grid(grid, aggregation_params.supersample)
+    elif mosaic_params.source == 'layers':
+        mosaic, transform, offsets = aggregate_mosaic(grid, aggregation_params.workers or os.cpu_count())
+    elif mosaic_params.source == 'store':
+        mosaic, transform, offsets = mosaic_from_store(grid)
+    else:
+        raise ValueError(f"Unknown mosaic source '{mosaic_params.source}', expected 'layers' or 'store'")
+
+    save_mosaic(mosaic, transform, offsets, mosaic_params.path)
+    if mosaic_params.geotiff is not None:
+        write_geotiff(mosaic, transform, mosaic_params.geotiff)
+    print(f"{mosaic.shape[1]}x{mosaic.shape[2]} mosaic of {len(offsets)} pictures saved to {mosaic_params.path}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
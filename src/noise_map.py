@@ -0,0 +1,78 @@
+import time
+import numpy as np
+import rasterio
+import torch
+import torch.nn.functional as F
+from src.model import CNNClassifier, FullyConvolutionalClassifier
+from src.mosaic import load_mosaic
+from src.utils import load_params
+
+
+
+STRIDE = 8
+NODATA = -1
+
+
+
+def predict_noise_map(model: FullyConvolutionalClassifier,
+                      mosaic: np.ndarray,
+                      valid: np.ndarray) -> np.ndarray:
+    # Output cell (i, j) is the 8x8 pixel block at mosaic[8i:8i+8, 8j:8j+8], scored with the
+    # 24x24 window centred on it. The mosaic is zero padded by one block on every side so the
+    # blocks along the edge get a window too, like the picture edges in training
+    height, width = valid.shape
+    pad_bottom = -height % STRIDE + STRIDE
+    pad_right = -width % STRIDE + STRIDE
+    x = F.pad(torch.from_numpy(mosaic[1:]), (STRIDE, pad_right, STRIDE, pad_bottom)).unsqueeze(0)
+    with torch.inference_mode():
+        probabilities = F.softmax(model(x), dim = 1)[0].numpy()
+
+    blocks = np.pad(valid, ((0, pad_bottom - STRIDE), (0, pad_right - STRIDE)))
+    blocks = blocks.reshape(blocks.shape[0] // STRIDE, STRIDE, blocks.shape[1] // STRIDE, STRIDE).any(axis = (1, 3))
+    noise_map = np.concatenate([probabilities, probabilities.argmax(axis = 0)[None].astype(np.float32)])
+    noise_map[:, ~blocks] = NODATA
+    return noise_map
+
+
+
+def write_noise_map(noise_map: np.ndarray, transform: rasterio.Affine, path: str) -> None:
+    profile = {
+        'driver': 'GTiff',
+        'height': noise_map.shape[1],
+        'width': noise_map.shape[2],
+        'count': noise_map.shape[0],
+        'dtype': 'float32',
+        'crs': 'EPSG:5514',
+        'transform': transform * rasterio.Affine.scale(STRIDE),
+        'nodata': NODATA,
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(noise_map)
+        for band in range(noise_map.shape[0] - 1):
+            dst.set_band_description(band + 1, f"prob_{band}")
+        dst.set_band_description(noise_map.shape[0], 'predicted_class')
+    return
+
+
+
+def main() -> None:
+    params = load_params()
+    classifier = CNNClassifier(num_classes = 4)
+    classifier.load_state_dict(torch.load('model/best_model.pth', map_location = 'cpu'))
+    model = FullyConvolutionalClassifier(classifier.eval())
+
+    mosaic, header = load_mosaic(params.mosaic_params.path)
+    valid = ~np.isnan(mosaic[0])
+    mosaic = np.nan_to_num(mosaic)
+    start = time.perf_counter()
+    noise_map = predict_noise_map(model, mosaic, valid)
+    elapsed = time.perf_counter() - start
+
+    write_noise_map(noise_map, header['transform'], params.predict_params.noise_map)
+    print(f"{noise_map.shape[1]}x{noise_map.shape[2]} noise map computed in {elapsed:.2f}s, saved to {params.predict_params.noise_map}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
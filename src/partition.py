@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import geopandas as gpd
+import shapely
+from src.preprocessing import LAYER_FILES, valid_path
+
+
+
+PARTITION_PATH = 'data/partition'
+GRID_PATH = 'data/S2_GRID.geojson'
+# Layers the aggregation uses unclipped, like the sjoin it replaces
+UNCLIPPED_LAYERS = ['population']
+
+
+
+class LayerPartition:
+    # Features of one layer assigned to the S2 pictures they intersect, stored as one sorted run of
+    # feature positions per picture. crosses marks features that are not covered by the picture
+    def __init__(self, 
+                 picture_ids: np.ndarray, 
+                 indptr: np.ndarray, 
+                 features: np.ndarray, 
+                 crosses: np.ndarray, 
+                 n_features: int) -> None:
+        self.picture_ids = picture_ids
+        self.n_features = n_features
+        self.indptr = indptr
+        self.features = features
+        self.crosses = crosses
+        self.rows = {int(picture_id): row for row, picture_id in enumerate(picture_ids)}
+
+    @classmethod
+    def build(cls, layer: gpd.GeoDataFrame, grid: gpd.GeoDataFrame) -> 'LayerPartition':
+        pictures = np.asarray(grid.geometry)
+        tree = shapely.STRtree(np.asarray(layer.geometry))
+        picture_idx, feature_idx = tree.query(pictures, predicate = 'intersects')
+        order = np.lexsort((feature_idx, picture_idx))
+        picture_idx, feature_idx = picture_idx[order], feature_idx[order]
+        shapely.prepare(pictures)
+        crosses = ~shapely.covers(pictures[picture_idx], np.asarray(layer.geometry)[feature_idx])
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(picture_idx, minlength = len(pictures)))])
+        return cls(grid.index.to_numpy(), indptr, feature_idx, crosses, len(layer))
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, picture_ids = self.picture_ids, indptr = self.indptr, features = self.features, 
+                 crosses = self.crosses, n_features = self.n_features)
+        os.replace(tmp_path, path)
+        return
+
+    @classmethod
+    def load(cls, path: str) -> 'LayerPartition':
+        data = np.load(path)
+        return cls(data['picture_ids'], data['indptr'], data['features'], data['crosses'], int(data['n_features']))
+
+    def subset(self, layer: gpd.GeoDataFrame, picture_id: int, picture, clip: bool = True) -> gpd.GeoDataFrame:
+        # Features of the picture fetched by position, only the ones crossing its boundary are clipped
+        row = self.rows[picture_id]
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        subset = layer.iloc[self.features[start:stop]]
+        if not clip:
+            return subset
+        crosses = self.crosses[start:stop]
+        if crosses.any():
+            subset = subset.copy()
+            subset.loc[crosses, subset.geometry.name] = shapely.intersection(np.asarray(subset.geometry)[crosses], picture)
+            subset = subset[~subset.geometry.is_empty]
+        return subset
+
+
+
+def load_partitions(layers: dict[str, gpd.GeoDataFrame],
+                    grid: gpd.GeoDataFrame = None,
+                    path: str = PARTITION_PATH) -> dict[str, LayerPartition]:
+    # Partitions are rebuilt when the grid or any repaired layer is newer than them
+    sources = [GRID_PATH] + [valid_path(os.path.join('data', file)) for file in LAYER_FILES]
+    newest_source = max(os.path.getmtime(source) for source in sources if os.path.exists(source))
+    os.makedirs(path, exist_ok = True)
+
+    partitions = {}
+    for name, layer in layers.items():
+        file_path = os.path.join(path, f"{name}.npz")
+        if os.path.exists(file_path) and os.path.getmtime(file_path) >= newest_source:
+            partitions[name] = LayerPartition.load(file_path)
+            if partitions[name].n_features == len(layer):
+                continue
+        if grid is None:
+            grid = gpd.read_file(GRID_PATH)
+        partitions[name] = LayerPartition.build(layer, grid)
+        partitions[name].save(file_path)
+    return partitions
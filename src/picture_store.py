@@ -0,0 +1,101 @@
+import os
+import glob
+import re
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.dataset as ds
+
+
+
+STORE_PATH = 'data/pictures.parquet'
+FEATURE_COLUMNS = ['weighted_db_hi', 'max_speed', 'has_transport_line', 'has_barrier',
+                   'parks_area', 'buildings_levels', 'population']
+
+
+
+def part_path(picture_id: int, store_path: str = STORE_PATH) -> str:
+    return os.path.join(store_path, f"picture_{picture_id}.parquet")
+
+
+
+def has_picture(picture_id: int, store_path: str = STORE_PATH) -> bool:
+    return os.path.exists(part_path(picture_id, store_path))
+
+
+
+def write_picture(pixels: gpd.GeoDataFrame, picture_id: int, store_path: str = STORE_PATH) -> None:
+    # pixel_id is the row-major position in the picture, counted from the north-west corner,
+    # so the pixels can be laid out as an image without reading their geometry
+    bounds = pixels.geometry.bounds
+    pixels = pixels.iloc[np.lexsort((bounds['minx'], -bounds['miny']))].copy()
+    pixels.insert(0, 'pixel_id', np.arange(len(pixels)))
+    pixels.insert(0, 'picture_id', picture_id)
+    pixels = pixels.reset_index(drop = True)
+
+    # Files starting with '.' are ignored by the dataset reader, so a half-written part is never read
+    os.makedirs(store_path, exist_ok = True)
+    tmp_path = os.path.join(store_path, f".picture_{picture_id}.parquet.tmp")
+    pixels.to_parquet(tmp_path, index = False)
+    os.replace(tmp_path, part_path(picture_id, store_path))
+    return
+
+
+
+def remove_partial_writes(store_path: str = STORE_PATH) -> None:
+    for tmp_path in glob.glob(os.path.join(store_path, '.*.tmp')):
+        os.remove(tmp_path)
+    return
+
+
+
+def picture_ids(store_path: str = STORE_PATH) -> list[int]:
+    files = glob.glob(os.path.join(store_path, 'picture_*.parquet'))
+    return sorted(int(re.search(r"picture_(\d+)\.parquet$", file).group(1)) for file in files)
+
+
+
+def read_pictures(columns: list[str] = None,
+                  ids: list[int] = None,
+                  store_path: str = STORE_PATH) -> pd.DataFrame:
+    # Column-projected read without the geometry, sorted by picture and pixel
+    columns = FEATURE_COLUMNS if columns is None else columns
+    columns = ['picture_id', 'pixel_id'] + [col for col in columns if col not in ('picture_id', 'pixel_id')]
+    dataset = ds.dataset(store_path, format = 'parquet')
+    row_filter = ds.field('picture_id').isin(ids) if ids is not None else None
+    df = dataset.to_table(columns = columns, filter = row_filter).to_pandas()
+    return df.sort_values(['picture_id', 'pixel_id']).reset_index(drop = True)
+
+
+
+def read_pictures_gdf(columns: list[str] = None,
+                      ids: list[int] = None,
+                      store_path: str = STORE_PATH) -> gpd.GeoDataFrame:
+    columns = FEATURE_COLUMNS if columns is None else columns
+    columns = ['picture_id', 'pixel_id'] + [col for col in columns if col not in ('picture_id', 'pixel_id', 'geometry')]
+    row_filter = ds.field('picture_id').isin(ids) if ids is not None else None
+    gdf = gpd.read_parquet(store_path, columns = columns + ['geometry'], filters = row_filter)
+    return gdf.sort_values(['picture_id', 'pixel_id']).reset_index(drop = True)
+
+
+
+def import_geojson_pictures(pictures_dir: str = 'data/pictures', store_path: str = STORE_PATH) -> None:
+    # One-off migration of pictures aggregated into per-picture GeoJSON files
+    files = glob.glob(os.path.join(pictures_dir, 'picture_*.geojson'))
+    for file in files:
+        picture_id = int(re.search(r"picture_(\d+)\.geojson$", file).group(1))
+        if not has_picture(picture_id, store_path):
+            write_picture(gpd.read_file(file), picture_id, store_path)
+    print(f"{len(files)} pictures from {pictures_dir} available in {store_path}")
+    return
+
+
+
+def main() -> None:
+    import_geojson_pictures()
+    return
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import time
+import argparse
+import pandas as pd
+import geopandas as gpd
+import torch
+import torch.nn.functional as F
+from src.model import CNNClassifier
+from src.aggregation import aggregate_pictures
+from src.convert_to_tensor import pictures_to_tensor
+from src.picture_store import STORE_PATH, has_picture, read_pictures, remove_partial_writes
+from src.utils import load_params
+
+
+
+class Predictor:
+    # Loads and warms up the model once, then scores any number of pictures in batches
+    def __init__(self,
+                 model_path: str = 'model/best_model.pth',
+                 batch_size: int = 256,
+                 num_threads: int = None,
+                 num_classes: int = 4) -> None:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.batch_size = batch_size
+        self.num_classes = num_classes
+        if model_path.endswith('.pt'):
+            # TorchScript artifact written by src/export.py
+            self.model = torch.jit.load(model_path, map_location = 'cpu')
+        else:
+            self.model = CNNClassifier(num_classes = num_classes)
+            self.model.load_state_dict(torch.load(model_path, map_location = 'cpu'))
+        self.model.eval()
+        self.predict_proba(torch.zeros(self.batch_size, 6, 25, 25))
+
+    def predict_proba(self, features: torch.tensor) -> torch.tensor:
+        probabilities = [torch.empty(0, self.num_classes)]
+        with torch.inference_mode():
+            for start in range(0, features.shape[0], self.batch_size):
+                outputs = self.model(features[start:start + self.batch_size].float())
+                probabilities.append(F.softmax(outputs, dim = 1))
+        return torch.cat(probabilities)
+
+
+
+def select_pictures(aoi_path: str = None, ids: list[int] = None) -> gpd.GeoDataFrame:
+    pictures = gpd.read_file("data/S2_GRID.geojson")
+    if ids is not None:
+        return pictures.loc[ids]
+    aoi = gpd.read_file(aoi_path).to_crs(pictures.crs)
+    return pictures[pictures.intersects(aoi.union_all())]
+
+
+
+def picture_features(ids: list[int], store_path: str = STORE_PATH) -> torch.tensor:
+    # The same channels and layout as the training features, without the noise label channel
+    df = read_pictures(ids = ids, store_path = store_path)
+    return pictures_to_tensor(df)[:, :, :, 1:].permute(0, 3, 1, 2)
+
+
+
+def predict_pictures(predictor: Predictor, pictures: gpd.GeoDataFrame) -> pd.DataFrame:
+    params = load_params()
+    remove_partial_writes()
+    tasks = [(i, picture) for i, picture in pictures.geometry.items() if not has_picture(i)]
+    aggregate_pictures(tasks, params.aggregation_params.workers or os.cpu_count(), params.s2_grid_params)
+
+    ids = sorted(pictures.index)
+    probabilities = predictor.predict_proba(picture_features(ids))
+    predictions = pd.DataFrame(probabilities.numpy(), columns = [f"prob_{c}" for c in range(predictor.num_classes)])
+    predictions.insert(0, 'picture_id', ids)
+    predictions['predicted_class'] = probabilities.argmax(dim = 1).numpy()
+    return predictions
+
+
+
+def main() -> None:
+    params = load_params().predict_params
+    parser = argparse.ArgumentParser(description = 'Noise class probabilities for S2 pictures')
+    area = parser.add_mutually_exclusive_group(required = True)
+    area.add_argument('--aoi', help = 'vector file with the area of interest, every intersecting picture is scored')
+    area.add_argument('--picture-ids', type = int, nargs = '+', help = 'S2 picture ids to score')
+    parser.add_argument('--output', default = params.output)
+    parser.add_argument('--batch-size', type = int, default = params.batch_size)
+    parser.add_argument('--num-threads', type = int, default = params.num_threads)
+    args = parser.parse_args()
+
+    predictor = Predictor(params.model_path, args.batch_size, args.num_threads)
+    pictures = select_pictures(args.aoi, args.picture_ids)
+    start = time.perf_counter()
+    predictions = predict_pictures(predictor, pictures)
+    elapsed = time.perf_counter() - start
+
+    predictions.to_csv(args.output, index = False)
+    print(f"{len(predictions)} pictures scored in {elapsed:.2f}s, predictions saved to {args.output}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,11 @@
 import os
+import json
+import numpy as np
 import geopandas as gpd
+import shapely
+import pyarrow.parquet as pq
+from shapely.errors import GEOSException
+from src.utils import file_sha256
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -22,10 +28,120 @@ def shp2geojson(file_path: str) -> None:
 
 
 
+# Repaired copies and boundaries are cached in these directories next to the source layers
+VALID_DIR = 'valid'
+BOUNDARY_DIR = 'boundaries'
+LAYER_FILES = ['NOISE.geojson', 'TRANSPORT_LINES.geojson', 'NOISE_BARRIERS.geojson', 'NOISE_BARRIERS_2.geojson',
+               'PARKS.geojson', 'BUILDINGS.geojson', 'DEMOGRAPHY.geojson', 'ROADS.geojson']
+ROW_GROUP_SIZE = 16384
+
+
+
+def make_valid(geometries: gpd.GeoSeries) -> tuple[gpd.GeoSeries, int]:
+    # Repairs the invalid geometries only. make_valid can return parts of a lower dimension, like the
+    # lines of a zero-area polygon or the point of a degenerate line, only the parts of the original
+    # dimension are kept. Geometries with no such part left become missing
+    invalid = (~geometries.is_valid & geometries.notna()).to_numpy()
+    original = np.asarray(geometries)[invalid]
+    repaired = shapely.make_valid(original)
+    parts, index = shapely.get_parts(repaired, return_index = True)
+    lost = shapely.get_dimensions(parts) != shapely.get_dimensions(original)[index]
+    for i in np.unique(index[lost]):
+        kept = parts[(index == i) & ~lost]
+        repaired[i] = shapely.union_all(kept) if len(kept) else None
+    geometries = geometries.copy()
+    geometries[invalid] = repaired
+    return geometries, int(invalid.sum())
+
+
+
+def valid_path(file_path: str) -> str:
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(os.path.dirname(file_path), VALID_DIR, f"{name}.parquet")
+
+
+
+def _has_bbox_covering(parquet_path: str) -> bool:
+    geo = json.loads(pq.read_schema(parquet_path).metadata[b'geo'])
+    return 'covering' in geo['columns'][geo['primary_column']]
+
+
+
+def convert_layer(file_path: str) -> str:
+    # Repaired copy of a source layer as GeoParquet, rebuilt when the source is newer. The copy carries
+    # a bbox covering column, so readers can skip features outside a bbox without decoding them
+    cache_path = valid_path(file_path)
+    if (os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path)
+            and _has_bbox_covering(cache_path)):
+        return cache_path
+
+    gdf = gpd.read_file(file_path, engine = 'pyogrio', use_arrow = True)
+    missing = gdf.geometry.isna()
+    gdf.geometry, n_repaired = make_valid(gdf.geometry)
+    # Features whose repair left nothing of their dimension cannot be aggregated
+    collapsed = gdf.geometry.isna() & ~missing
+    gdf = gdf[~collapsed].reset_index(drop = True)
+    os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+    tmp_path = os.path.join(os.path.dirname(cache_path), f".{os.path.basename(cache_path)}.tmp")
+    gdf.to_parquet(tmp_path, write_covering_bbox = True, row_group_size = ROW_GROUP_SIZE)
+    os.replace(tmp_path, cache_path)
+    print(f"{file_path}: {n_repaired} invalid geometries repaired, {collapsed.sum()} of them dropped, saved to {cache_path}")
+    return cache_path
+
+
+
+def dissolve(geometries: np.ndarray):
+    # Coverage union only merges shared edges, so it is much faster but only correct for polygons that
+    # do not overlap, like districts. Anything else goes through the full union
+    try:
+        coverage = shapely.coverage_union_all(geometries)
+        if coverage.is_valid and np.isclose(coverage.area, shapely.area(geometries).sum(), rtol = 1e-9):
+            return coverage
+    except GEOSException:
+        pass
+    return shapely.union_all(geometries)
+
+
+
+def read_boundary(file_path: str):
+    # Dissolved outline of a layer, cached under the hash of the source file
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    boundary_dir = os.path.join(os.path.dirname(file_path), BOUNDARY_DIR)
+    cache_path = os.path.join(boundary_dir, f"{name}-{file_sha256(file_path)[:16]}.wkb")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return shapely.from_wkb(f.read())
+
+    boundary = dissolve(np.asarray(gpd.read_parquet(convert_layer(file_path), columns = ['geometry']).geometry))
+    os.makedirs(boundary_dir, exist_ok = True)
+    tmp_path = os.path.join(boundary_dir, f".{os.path.basename(cache_path)}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(shapely.to_wkb(boundary))
+    os.replace(tmp_path, cache_path)
+    return boundary
+
+
+
+def clip_to(layer: gpd.GeoDataFrame, mask) -> gpd.GeoDataFrame:
+    # Same result as gpd.clip with a polygon mask, but candidates come from the spatial index and only
+    # the features crossing the mask boundary are intersected, the ones inside are kept as they are
+    shapely.prepare(mask)
+    clipped = layer.iloc[np.sort(layer.sindex.query(mask, predicate = 'intersects'))]
+    crosses = ~shapely.covers(mask, np.asarray(clipped.geometry))
+    if crosses.any():
+        clipped = clipped.copy()
+        clipped.loc[crosses, clipped.geometry.name] = shapely.intersection(np.asarray(clipped.geometry)[crosses], mask)
+        clipped = clipped[~clipped.geometry.is_empty]
+    return clipped
+
+
+
 def main() -> None:
     data_paths = [os.path.join('data', file) for file in os.listdir('data') if file.endswith('.zip') or file.endswith('.geojson') and file != 'S2_GRID.geojson']
     for data in data_paths:
         shp2geojson(data)
+    for file in LAYER_FILES:
+        convert_layer(os.path.join('data', file))
     return
 
 
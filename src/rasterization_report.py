@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.aggregation import aggregate_picture
+from src.mosaic import PIXELS_ON_SIDE, load_mosaic_layers, rasterize_grid
+from src.partition import load_partitions
+from src.picture_store import FEATURE_COLUMNS
+from src.utils import load_params
+
+
+
+def picture_pixels(mosaic: np.ndarray, row: int, col: int) -> np.ndarray:
+    return mosaic[:, row:row + PIXELS_ON_SIDE, col:col + PIXELS_ON_SIDE].reshape(len(FEATURE_COLUMNS), -1)
+
+
+
+def aggregated_pixels(pixels: pd.DataFrame) -> np.ndarray:
+    # Pixels of aggregate_picture in the row-major order of the picture store, as a (channels, pixels) array
+    bounds = pixels.geometry.bounds
+    pixels = pixels.iloc[np.lexsort((bounds['minx'], -bounds['miny']))]
+    return pixels[FEATURE_COLUMNS].apply(pd.to_numeric, errors = 'coerce').fillna(0).to_numpy(dtype = np.float32).T
+
+
+
+def compare_channels(exact: np.ndarray, approximate: np.ndarray) -> dict[str, dict[str, float]]:
+    # exact and approximate are (channels, pixels) arrays of the same pictures
+    report = {}
+    for channel, truth, estimate in zip(FEATURE_COLUMNS, exact, approximate):
+        error = np.abs(estimate.astype(float) - truth)
+        report[channel] = {
+            'mean_abs_error': float(error.mean()),
+            'max_abs_error': float(error.max()),
+            'share_equal': float(np.mean(error < 1e-6)),
+            'mean_exact_value': float(truth.mean()),
+        }
+    return report
+
+
+
+def main(n_pictures: int = 20, seed: int = 0) -> None:
+    params = load_params()
+    supersample = params.aggregation_params.supersample
+    grid = gpd.read_file("data/S2_GRID.geojson")
+    sample = np.sort(np.random.default_rng(seed).choice(len(grid), min(n_pictures, len(grid)), replace = False))
+    layers = load_mosaic_layers()
+
+    # The raster backend always covers the whole city, the exact baseline is aggregate_picture, which
+    # fills the picture store, on the sampled pictures only
+    start = time.perf_counter()
+    raster, _, offsets = rasterize_grid(grid, supersample, layers)
+    raster_time = time.perf_counter() - start
+    partitions = load_partitions(layers, grid)
+    pictures = [int(i) for i in grid.index[sample]]
+    start = time.perf_counter()
+    exact = [aggregated_pixels(aggregate_picture(grid.geometry[i], layers, params.s2_grid_params, partitions, i))
+             for i in pictures]
+    exact_time = time.perf_counter() - start
+
+    exact_pixels = np.concatenate(exact, axis = 1)
+    raster_pixels = np.concatenate([picture_pixels(raster, *offsets[i]) for i in pictures], axis = 1)
+    report = {
+        'supersample': supersample,
+        'pictures': pictures,
+        'raster_seconds_city': raster_time,
+        'exact_seconds_per_picture': exact_time / len(sample),
+        'exact_seconds_city_estimate': exact_time / len(sample) * len(grid),
+        'channels': compare_channels(exact_pixels, raster_pixels),
+    }
+    os.makedirs('data/reports', exist_ok = True)
+    with open('data/reports/rasterization.json', 'w') as f:
+        json.dump(report, f, indent = 4)
+
+    print(f"raster backend: {raster_time:.1f}s for the city, exact: {report['exact_seconds_city_estimate']:.1f}s estimated")
+    print(f"{'channel':<20} {'mean abs err':>13} {'max abs err':>12} {'equal':>7} {'mean':>10}")
+    for channel, row in report['channels'].items():
+        print(f"{channel:<20} {row['mean_abs_error']:>13.4f} {row['max_abs_error']:>12.4f} "
+              f"{row['share_equal']:>7.2%} {row['mean_exact_value']:>10.4f}")
+    return
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from affine import Affine
+from rasterio.features import rasterize
+from rasterio.enums import MergeAlg
+from src.picture_store import FEATURE_COLUMNS
+
+
+
+def burn(shapes: list[tuple],
+         shape: tuple[int, int],
+         transform: Affine,
+         merge_alg: MergeAlg = MergeAlg.replace,
+         all_touched: bool = False) -> np.ndarray:
+    if not shapes:
+        return np.zeros(shape, dtype = np.float32)
+    return rasterize(shapes, out_shape = shape, transform = transform, fill = 0,
+                     merge_alg = merge_alg, all_touched = all_touched, dtype = 'float32')
+
+
+
+def block_reduce(fine: np.ndarray, factor: int, reduce: str = 'sum') -> np.ndarray:
+    blocks = fine.reshape(fine.shape[0] // factor, factor, fine.shape[1] // factor, factor)
+    if reduce == 'max':
+        return blocks.max(axis = (1, 3))
+    return blocks.sum(axis = (1, 3), dtype = np.float64)
+
+
+
+def rasterize_mosaic(layers: dict[str, gpd.GeoDataFrame],
+                     transform: Affine,
+                     height: int,
+                     width: int,
+                     supersample: int = 8) -> np.ndarray:
+    # Burns every layer once into a grid supersample times finer than the pixels and reduces each
+    # supersample x supersample block to one pixel. Areas become counts of covered fine cells, lines
+    # mark every fine cell they touch
+    fine_shape = (height * supersample, width * supersample)
+    fine_transform = Affine(transform.a / supersample, 0, transform.c, 0, transform.e / supersample, transform.f)
+    n_cells = supersample * supersample
+    channels = {}
+
+    # Sum of DB_HI weighted by the covered share of the pixel, rounded to 5 dB
+    noise = layers['noise']
+    db_sum = block_reduce(burn(list(zip(noise.geometry, noise['DB_HI'])), fine_shape, fine_transform, MergeAlg.add), supersample)
+    coverage = block_reduce(burn([(geom, 1) for geom in noise.geometry], fine_shape, fine_transform, MergeAlg.add), supersample)
+    channels['weighted_db_hi'] = np.where(coverage > 0, np.round(db_sum / n_cells / 5) * 5, 0)
+
+    # Faster roads are burnt last, so every fine cell keeps the highest speed touching it
+    roads = layers['roads'].assign(speed = pd.to_numeric(layers['roads']['maxspeed'], errors = 'coerce'))
+    roads = roads[roads['speed'].notna()].sort_values('speed', kind = 'stable')
+    channels['max_speed'] = block_reduce(burn(list(zip(roads.geometry, roads['speed'])), fine_shape, fine_transform,
+                                              all_touched = True), supersample, 'max')
+
+    for column, layer in [('has_transport_line', 'transport_lines'), ('has_barrier', 'noise_barriers')]:
+        lines = burn([(geom, 1) for geom in layers[layer].geometry], fine_shape, fine_transform, all_touched = True)
+        channels[column] = block_reduce(lines, supersample, 'max')
+
+    parks = layers['parks']
+    channels['parks_area'] = block_reduce(burn([(geom, 1) for geom in parks.geometry], fine_shape, fine_transform,
+                                               MergeAlg.add), supersample) / n_cells
+
+    # Levels covering most of the pixel, ties resolved by the lowest levels
+    buildings = layers['buildings']
+    levels = np.sort(buildings['buildings_levels'].dropna().unique())
+    level_index = burn(list(zip(buildings.geometry, np.searchsorted(levels, buildings['buildings_levels']) + 1)),
+                       fine_shape, fine_transform)
+    channels['buildings_levels'] = np.zeros((height, width))
+    if len(levels):
+        counts = np.stack([block_reduce(level_index == i + 1, supersample) for i in range(len(levels))])
+        channels['buildings_levels'] = np.where(counts.max(axis = 0) > 0, levels[counts.argmax(axis = 0)], 0)
+
+    # Population spread evenly over each district
+    population = layers['population']
+    density = population['population'].to_numpy(dtype = float) / population['district_area'].to_numpy()
+    cell_area = fine_transform.a * -fine_transform.e
+    channels['population'] = block_reduce(burn(list(zip(population.geometry, density)), fine_shape, fine_transform,
+                                               MergeAlg.add), supersample) * cell_area
+
+    return np.stack([channels[column] for column in FEATURE_COLUMNS]).astype(np.float32)
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import queue
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from src.predict import Predictor, picture_features
+from src.picture_store import STORE_PATH, picture_ids
+from src.utils import load_params
+
+
+
+class _Request:
+    def __init__(self, features: torch.tensor) -> None:
+        self.features = features
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.probabilities = None
+        self.error = None
+
+
+
+class MicroBatcher:
+    # Collects concurrent requests and runs them through the model together. A batch is sent as
+    # soon as it holds max_batch_size samples or its oldest request has waited max_latency_ms
+    def __init__(self, predictor: Predictor, max_batch_size: int = 256, max_latency_ms: float = 5) -> None:
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen = 10000)
+        self.batch_sizes = collections.Counter()
+        self.lock = threading.Lock()
+        threading.Thread(target = self._run, daemon = True).start()
+
+    def predict(self, features: torch.tensor) -> torch.tensor:
+        request = _Request(features)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.probabilities
+
+    def _collect(self) -> list[_Request]:
+        batch = [self.requests.get()]
+        n_samples = batch[0].features.shape[0]
+        deadline = batch[0].enqueued + self.max_latency
+        while n_samples < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout = timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_samples += request.features.shape[0]
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                probabilities = self.predictor.predict_proba(torch.cat([request.features for request in batch]))
+                for request, result in zip(batch, probabilities.split([len(request.features) for request in batch])):
+                    request.probabilities = result
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finished = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[sum(len(request.features) for request in batch)] += 1
+                self.latencies.extend((finished - request.enqueued) * 1000 for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+        return {
+            'requests': int(len(latencies)),
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            },
+            'batch_size_histogram': {str(size): count for size, count in batch_sizes.items()},
+        }
+
+
+
+class PictureFeatures:
+    # Features of every aggregated picture, loaded once so id lookups never touch the disk
+    def __init__(self, store_path: str = STORE_PATH) -> None:
+        ids = picture_ids(store_path) if os.path.exists(store_path) else []
+        self.index = {picture_id: i for i, picture_id in enumerate(ids)}
+        self.features = picture_features(ids, store_path) if ids else torch.empty(0, 6, 25, 25)
+
+    def __getitem__(self, ids: list[int]) -> torch.tensor:
+        missing = [picture_id for picture_id in ids if picture_id not in self.index]
+        if missing:
+            raise KeyError(f"Pictures not found in the picture store: {missing}")
+        return self.features[[self.index[picture_id] for picture_id in ids]]
+
+
+
+def make_handler(batcher: MicroBatcher, pictures: PictureFeatures) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self) -> None:
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics())
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path != '/predict':
+                self._send_json(404, {'error': f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if 'picture_ids' in body:
+                    features = pictures[[int(picture_id) for picture_id in body['picture_ids']]]
+                elif 'features' in body:
+                    features = torch.tensor(body['features'], dtype = torch.float32)
+                    if features.dim() == 3:
+                        features = features.unsqueeze(0)
+                    if tuple(features.shape[1:]) != (6, 25, 25):
+                        raise ValueError(f"Expected features of shape (N, 6, 25, 25), got {tuple(features.shape)}")
+                else:
+                    raise ValueError("Request body needs either 'features' or 'picture_ids'")
+            except KeyError as e:
+                self._send_json(404, {'error': str(e)})
+                return
+            except (ValueError, TypeError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+
+            probabilities = batcher.predict(features)
+            self._send_json(200, {
+                'probabilities': probabilities.tolist(),
+                'predicted_class': probabilities.argmax(dim = 1).tolist(),
+            })
+
+        def log_message(self, format: str, *args) -> None:
+            return
+
+    return Handler
+
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+
+def main() -> None:
+    params = load_params()
+    serve_params = params.serve_params
+    predictor = Predictor(params.predict_params.model_path, serve_params.max_batch_size, params.predict_params.num_threads)
+    batcher = MicroBatcher(predictor, serve_params.max_batch_size, serve_params.max_latency_ms)
+    handler = make_handler(batcher, PictureFeatures())
+
+    if serve_params.unix_socket is not None:
+        if os.path.exists(serve_params.unix_socket):
+            os.remove(serve_params.unix_socket)
+        server = UnixHTTPServer(serve_params.unix_socket, handler)
+        print(f"Serving on unix socket {serve_params.unix_socket}")
+    else:
+        server = ThreadingHTTPServer((serve_params.host, serve_params.port), handler)
+        print(f"Serving on http://{serve_params.host}:{serve_params.port}")
+    server.serve_forever()
+    return
+
+
+
+if __name__ == '__main__':
+    main()
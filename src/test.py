@@ -1,11 +1,10 @@
 import torch
 import torch.nn as nn
 import json
-from tqdm import tqdm
-from sklearn.metrics import accuracy_score
 from src.model import *
-import json
+from src.model import _validate
 import torchvision.transforms as transforms
+from src.utils import load_params
 
 
 
@@ -13,45 +12,34 @@ def evaluate_model(model: CNNClassifier,
                    dataloader: DataLoader, 
                    criterion: nn.CrossEntropyLoss, 
                    device: str) -> tuple[float, float]:
-    model.eval()
-    total_loss = 0
-    all_preds = []
-    all_labels = []
-
-    with torch.no_grad():
-        for inputs, labels in tqdm(dataloader, desc="Testing", leave=False):
-            inputs, labels = inputs.float().to(device), labels.to(device)
-
-            # Forward
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-
-            total_loss += loss.item()
-            all_preds.extend(torch.argmax(outputs, dim=1).cpu().numpy())
-            all_labels.extend(labels.cpu().numpy())
-
-    accuracy = accuracy_score(all_labels, all_preds)
-    
-    return total_loss / len(dataloader), accuracy
+    return _validate(model, dataloader, criterion, device, desc = "Testing")
 
 
 
-def load_data(data: torch.Tensor) -> tuple[DataLoader, DataLoader, DataLoader]:
+def load_data(path: str = "data_to_train/tensors.npy") -> tuple[DataLoader, DataLoader, DataLoader]:
+    loader_params = load_params().dataloader_params
     transform = transforms.Compose([
         transforms.RandomHorizontalFlip(),
         transforms.RandomRotation(15),
         transforms.RandomAffine(degrees=0, translate=(0.1, 0.1)),
     ])
-    features_list, labels_list = get_data(data)
-    train_loader, val_loader, test_loader = create_dataloaders(features_list, labels_list, transform, 32)
+    if loader_params.dataset == 'mosaic':
+        path = load_params().mosaic_params.path
+    dataset = load_dataset(path, loader_params.dataset)
+    train_loader, val_loader, test_loader = split_dataloaders(dataset, 
+                                                              transform, 
+                                                              loader_params.batch_size, 
+                                                              None, 
+                                                              split_path(path), 
+                                                              loader_params.split_seed, 
+                                                              **loader_params.loader_kwargs())
     
     return train_loader, val_loader, test_loader
 
 
 
 def main() -> None:
-    data = torch.load("data_to_train/tensors.pt")
-    _, _, test_loader = load_data(data)
+    _, _, test_loader = load_data("data_to_train/tensors.npy")
     
     model = CNNClassifier(num_classes = 4)
     model.load_state_dict(torch.load('model/best_model.pth'))
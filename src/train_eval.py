@@ -2,36 +2,53 @@ from src.model import *
 import json
 import torchvision.transforms as transforms
 from src.plots import plot_metrics
+from src.utils import load_params
 
 
 
-def load_data(data: torch.Tensor) -> tuple[DataLoader, DataLoader, DataLoader]:
+def load_data(path: str = "data_to_train/tensors.npy") -> tuple[DataLoader, DataLoader, DataLoader]:
+    loader_params = load_params().dataloader_params
+    params = load_params().augmentation_params
     transform = transforms.Compose([
         transforms.RandomHorizontalFlip(),
-        transforms.RandomRotation(15),
-        transforms.RandomAffine(degrees = 0, translate = (0.1, 0.1)),
+        transforms.RandomRotation(params.degrees),
+        transforms.RandomAffine(degrees = 0, translate = (params.translate, params.translate)),
     ])
-    features_list, labels_list = get_data(data)
-    train_loader, val_loader, test_loader = create_dataloaders(features_list, labels_list, transform, 32)
+    batch_augmentation = None
+    if params.batched:
+        batch_augmentation = BatchAugmentation(params.degrees, params.translate, params.seed)
+    if loader_params.dataset == 'mosaic':
+        path = load_params().mosaic_params.path
+    dataset = load_dataset(path, loader_params.dataset)
+    train_loader, val_loader, test_loader = split_dataloaders(dataset, 
+                                                              transform, 
+                                                              loader_params.batch_size, 
+                                                              batch_augmentation, 
+                                                              split_path(path), 
+                                                              loader_params.split_seed, 
+                                                              **loader_params.loader_kwargs())
     
     return train_loader, val_loader, test_loader
 
 
 def main() -> None:
-    data = torch.load("data_to_train/tensors.pt")
-    train_loader, val_loader, _ = load_data(data)
+    train_loader, val_loader, _ = load_data("data_to_train/tensors.npy")
     
     model = CNNClassifier(num_classes = 4)
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr = 0.001, weight_decay = 1e-4)
     n_epochs = 50
+    train_params = load_params().train_params
     _, train_losses, val_losses, train_accs, val_accs, best_epoch = train_model(model, \
                                                                                      criterion, \
                                                                                      optimizer, \
                                                                                      n_epochs, \
                                                                                      train_loader, \
                                                                                      val_loader, \
-                                                                                     "cpu")
+                                                                                     "cpu", \
+                                                                                     compile = train_params.compile, \
+                                                                                     channels_last = train_params.channels_last, \
+                                                                                     autocast = train_params.autocast)
     results = {'best_loss': val_losses[best_epoch], 'best_acc': val_accs[best_epoch]}
     with open('model/val/best_results.json', 'w') as f:
         json.dump(results, f, indent=4)
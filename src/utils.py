@@ -1,8 +1,14 @@
+import os
+import hashlib
 import numpy as np
 import yaml
 import geopandas as gpd
 import matplotlib
 import matplotlib.cm as cm
+from dataclasses import dataclass
+
+
+PARAMS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'params.yaml')
 
 
 def load_yaml(file_path: str) -> dict[dict[str, str]]:
@@ -10,6 +16,148 @@ def load_yaml(file_path: str) -> dict[dict[str, str]]:
         return yaml.safe_load(file)
 
 
+def file_sha256(file_path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass(frozen = True)
+class DownloadParams:
+    workers: int = 4
+    retries: int = 5
+    backoff: float = 0.5
+    timeout: float = 60
+    chunk_size: int = 1 << 20
+    manifest: str = 'data/manifest.json'
+
+
+@dataclass(frozen = True)
+class S2GridParams:
+    side_length: int
+    thresh: float
+
+
+@dataclass(frozen = True)
+class AggregationParams:
+    workers: int | None = None
+    backend: str = 'vector'
+    supersample: int = 8
+
+
+@dataclass(frozen = True)
+class AugmentationParams:
+    batched: bool = True
+    degrees: float = 15
+    translate: float = 0.1
+    seed: int | None = None
+
+
+@dataclass(frozen = True)
+class DataLoaderParams:
+    dataset: str = 'memmap'
+    split_seed: int = 42
+    batch_size: int = 32
+    num_workers: int = 0
+    prefetch_factor: int = 2
+    persistent_workers: bool = False
+    pin_memory: bool = False
+
+    def loader_kwargs(self) -> dict:
+        # prefetch_factor and persistent_workers are only accepted by DataLoader together with workers
+        kwargs = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory}
+        if self.num_workers > 0:
+            kwargs.update(prefetch_factor = self.prefetch_factor, persistent_workers = self.persistent_workers)
+        return kwargs
+
+
+@dataclass(frozen = True)
+class TrainParams:
+    compile: bool = False
+    channels_last: bool = False
+    autocast: bool = False
+
+
+@dataclass(frozen = True)
+class PredictParams:
+    model_path: str = 'model/best_model.pth'
+    batch_size: int = 256
+    num_threads: int | None = None
+    output: str = 'model/predictions.csv'
+    noise_map: str = 'model/noise_map.tif'
+
+
+@dataclass(frozen = True)
+class MosaicParams:
+    path: str = 'data/mosaic.npy'
+    source: str = 'layers'
+    geotiff: str | None = None
+
+
+@dataclass(frozen = True)
+class ExportParams:
+    quantization: str = 'static'
+    calibration_batches: int = 16
+    max_accuracy_drop: float = 0.01
+    output: str = 'model/model_int8.pt'
+
+
+@dataclass(frozen = True)
+class ServeParams:
+    host: str = '127.0.0.1'
+    port: int = 8000
+    unix_socket: str | None = None
+    max_batch_size: int = 256
+    max_latency_ms: float = 5
+
+
+@dataclass(frozen = True)
+class Params:
+    download_data: dict[str, str]
+    download_params: DownloadParams
+    s2_grid_params: S2GridParams
+    aggregation_params: AggregationParams
+    augmentation_params: AugmentationParams
+    dataloader_params: DataLoaderParams
+    train_params: TrainParams
+    predict_params: PredictParams
+    serve_params: ServeParams
+    export_params: ExportParams
+    mosaic_params: MosaicParams
+
+    @classmethod
+    def from_dict(cls, params: dict) -> 'Params':
+        return cls(
+            download_data = params['download_data'],
+            download_params = DownloadParams(**params.get('download_params', {})),
+            s2_grid_params = S2GridParams(**params['s2_grid_params']),
+            aggregation_params = AggregationParams(**params.get('aggregation_params', {})),
+            augmentation_params = AugmentationParams(**params.get('augmentation_params', {})),
+            dataloader_params = DataLoaderParams(**params.get('dataloader_params', {})),
+            train_params = TrainParams(**params.get('train_params', {})),
+            predict_params = PredictParams(**params.get('predict_params', {})),
+            serve_params = ServeParams(**params.get('serve_params', {})),
+            export_params = ExportParams(**params.get('export_params', {})),
+            mosaic_params = MosaicParams(**params.get('mosaic_params', {})),
+        )
+
+
+_params_cache: dict[str, tuple[int, Params]] = {}
+
+
+def load_params(file_path: str = PARAMS_PATH) -> Params:
+    # Parsed once per process and re-read only when the file's mtime changes
+    file_path = os.path.abspath(file_path)
+    mtime = os.stat(file_path).st_mtime_ns
+    cached = _params_cache.get(file_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, Params.from_dict(load_yaml(file_path)))
+        _params_cache[file_path] = cached
+    return cached[1]
+
+
 def filter_poligon(gdf, gdf_district, district_name):
     selected_district = gdf_district[gdf_district['NAZEV_MC'] == district_name]  
     return gpd.overlay(gdf, selected_district, how = 'intersection'), selected_district